@@ -0,0 +1,636 @@
+# Copyright 2013 Kevin Lin
+# Licensed under the Apache License, Version 2.0
+
+""" Benchmarks for the template engine.
+
+Run with ``python -m texthon.benchmark`` from the source directory, which uses
+the sample templates in ``tests``.  Pass suite names to run only some of the
+suites, ``--json`` to save the results and ``--baseline`` to compare them with
+results saved before.
+"""
+
+from .engine import Engine
+from .parser import Parser, Regex_Parser
+from . import base
+from . import server
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+
+call_template = """
+#template row(name, value)
+$name = ${value + 1};
+#end template
+"""
+
+def best_time(func, number, repeat = 5):
+	""" returns the best time per call of func in microseconds """
+	return min(timeit.repeat(func, number = number, repeat = repeat)) / number * 1e6
+
+def best_time_setup(setup, func, number, repeat = 5):
+	""" like best_time, calling func with the result of setup, which isn't
+	part of the time
+	"""
+	times = []
+	for _ in range(repeat):
+		total = 0.0
+		for _ in range(number):
+			value = setup()
+			start = time.perf_counter()
+			func(value)
+			total += time.perf_counter() - start
+		times.append(total)
+	return min(times) / number * 1e6
+
+class Legacy_Parser(Parser):
+	""" Generates the code the exec path ran: one write per text and
+	placeholder, with nested template calls returning strings.
+	"""
+	optimize = False
+
+	def _split_call(self, exp):
+		return None
+
+def _legacy_call(func, definition):
+	# the module level exec path templates used before being compiled into
+	# functions: strip the def line and run the body with copied globals
+	body = "".join(line[1:] for line in definition.code.splitlines(True)[1:])
+	code = compile(body, func.path, "exec")
+	module = func.module
+	text = definition.text
+
+	def call(*args):
+		output = base.StringIO()
+		local_vars = {
+			"_module" : module,
+			"_textdb" : text,
+			"_output" : output,
+		}
+		for param, arg in zip(definition.params, args):
+			local_vars[param] = arg
+		global_vars = dict(module.__dict__)
+		global_vars.update(local_vars)
+		exec(code, global_vars, local_vars)
+		return output.getvalue()
+
+	return call
+
+def bench_call(number = 20000):
+	""" Compares the cost of calling a template with the old exec based
+	path and a hand written Python function producing the same text.
+	"""
+	engine = Engine()
+	engine.load_text(call_template, "call.tmpl")
+	engine.make()
+	func = engine.modules["call.tmpl"].row
+	definition = Legacy_Parser().process_module(base.StringIO(call_template), "call.tmpl").templates["row"]
+	legacy = _legacy_call(func, definition)
+
+	def python_row(name, value):
+		output = base.StringIO()
+		output.write(str(name))
+		output.write(" = ")
+		output.write(str(value + 1))
+		output.write(";\n")
+		return output.getvalue()
+
+	assert func("x", 1) == legacy("x", 1) == python_row("x", 1)
+
+	return {
+		"template" : best_time(lambda: func("x", 1), number),
+		"legacy exec" : best_time(lambda: legacy("x", 1), number),
+		"python" : best_time(lambda: python_row("x", 1), number),
+	}
+
+def mixin_library(count):
+	""" returns a module text with count templates """
+	out = base.StringIO()
+	for index in range(count):
+		out.write("#template t{0}(x)\nt{0} $x\n#end template\n".format(index))
+	return out.getvalue()
+
+def bench_mixin(counts = (10, 100, 1000), number = 2000):
+	""" Measures creating a mixin and calling one of its functions, for
+	libraries with an increasing number of templates.  The eager numbers
+	also bind every function, like mixins did before binding became lazy.
+	"""
+	results = {}
+	for count in counts:
+		engine = Engine()
+		engine.load_text(mixin_library(count), "lib.tmpl")
+		engine.load_text("#attribute x = 1\n", "other.tmpl")
+		engine.make()
+		lib = engine.modules["lib.tmpl"]
+		other = engine.modules["other.tmpl"]
+		names = list(lib._templates)
+
+		def lazy():
+			lib(other).t0(1)
+
+		def eager():
+			mixin = lib(other)
+			for name in names:
+				getattr(mixin, name)
+			mixin.t0(1)
+
+		results["lazy {}".format(count)] = best_time(lazy, number)
+		results["eager {}".format(count)] = best_time(eager, max(1, number // count))
+
+	return results
+
+def large_template(size):
+	""" returns a module text of roughly size characters, shaped like a code
+	generation library: mostly text with a few placeholders per template
+	"""
+	block = """#template t{0}(name, items)
+// generated for $name by the texthon benchmark, do not edit this file by hand
+class ${{name}}_{0} : public generated_base_class_with_a_fairly_long_name
+{{
+public:
+	virtual ~${{name}}_{0}() {{}}
+	virtual unsigned int get_id() const {{ return {0}; }}
+	virtual size_t field_count() const {{ return sizeof(m_fields) / sizeof(m_fields[0]); }}
+#{{for index, item in enumerate(items):
+	$<    static const int ${{item.upper()}}_{0} = $index; // $$ $name.$item
+#}}
+private:
+	typeinfo_base const* m_fields[16];
+	char const* m_names[16];
+}};
+#end template
+"""
+	out = base.StringIO()
+	index = 0
+	while out.tell() < size:
+		out.write(block.format(index))
+		index += 1
+	return out.getvalue()
+
+def bench_parse(size = 2 * 1024 * 1024):
+	""" Parses a large template file with both parser implementations """
+	text = large_template(size)
+	results = {}
+	for parser in (Parser(), Regex_Parser()):
+		results[type(parser).__name__] = best_time(
+			lambda: parser.process_module(base.StringIO(text), "large.tmpl"), 1, 3) / 1e3
+
+	return results
+
+def write_tree(directory, count, size):
+	""" writes count modules of roughly size characters to directory, module
+	i loads modules 2i + 1 and 2i + 2.  returns the path of the root module.
+	"""
+	for index in range(count):
+		out = base.StringIO()
+		for child in (2 * index + 1, 2 * index + 2):
+			if child < count:
+				out.write("#load 'm{0}.tmpl' as m{0}\n".format(child))
+		out.write(large_template(size))
+		with open(os.path.join(directory, "m{}.tmpl".format(index)), "w") as f:
+			f.write(out.getvalue())
+
+	return os.path.join(directory, "m0.tmpl")
+
+def bench_load(count = 64, size = 64 * 1024):
+	""" Loads a tree of template modules serially, with threads, and with
+	threads and worker processes parsing every file.
+	"""
+	directory = tempfile.mkdtemp()
+	try:
+		root = write_tree(directory, count, size)
+		results = {}
+		for label, parallel in (
+			("serial", None),
+			("threads", (8,)),
+			("threads + processes", (8, os.cpu_count() or 1, 0))):
+			def load():
+				engine = Engine()
+				if parallel:
+					engine.set_parallel(*parallel)
+				engine.load_file(root)
+			results[label] = best_time(load, 1, 3) / 1e3
+	finally:
+		shutil.rmtree(directory)
+
+	return results
+
+def bench_lazy(count = 5000):
+	""" Loads, makes and renders a main template that calls one template of
+	a library with count templates, eagerly and in lazy mode.  The unused
+	numbers are for a main template that doesn't touch the library at all.
+	"""
+	directory = tempfile.mkdtemp()
+	try:
+		with open(os.path.join(directory, "lib.tmpl"), "w") as f:
+			f.write(mixin_library(count))
+
+		results = {}
+		for use in (True, False):
+			main_text = "#load 'lib.tmpl' as lib\n#template main\n{}\n#end template\n".format(
+				"${lib.t0(1)}" if use else "main")
+			for lazy in (False, True):
+				def render():
+					engine = Engine()
+					engine.set_lazy(lazy)
+					engine.load_text(main_text, "main", directory)
+					engine.make()
+					engine.modules["main"].main()
+				label = "{} {}".format("lazy" if lazy else "eager", "used" if use else "unused")
+				results[label] = best_time(render, 1, 3) / 1e3
+	finally:
+		shutil.rmtree(directory)
+
+	return results
+
+def bench_serve(number = 10):
+	""" Compares the latency of rendering the html sample with a cold command
+	line run, a command line run forwarding to a server, and a request sent
+	straight to the server.
+	"""
+	root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+	template = "tests/html/doc.tmpl"
+	includes = ["tests/html/sections"]
+	command = [sys.executable, os.path.join(root, "scripts", "texthon"), template, "-I", includes[0]]
+	environment = dict(os.environ)
+	environment["PYTHONPATH"] = os.pathsep.join(filter(None, [root, environment.get("PYTHONPATH")]))
+
+	directory = tempfile.mkdtemp()
+	socket_path = os.path.join(directory, "texthon.sock")
+	render_server = server.Render_Server()
+	thread = threading.Thread(target = render_server.serve, args = (socket_path,))
+	thread.start()
+	try:
+		while render_server.server is None or not os.path.exists(socket_path):
+			time.sleep(0.01)
+
+		def run(*options):
+			subprocess.run(command + list(options), env = environment,
+				stdout = subprocess.DEVNULL, check = True)
+
+		return {
+			"cold cli" : best_time(lambda: run("--no-server"), number, 1) / 1e3,
+			"cli client" : best_time(lambda: run("--socket", socket_path), number, 1) / 1e3,
+			"request" : best_time(lambda: server.request(socket_path, template,
+				includes = includes), number * 10, 1) / 1e3,
+		}
+	finally:
+		render_server.shutdown()
+		thread.join()
+		shutil.rmtree(directory)
+
+# the sample templates: template, include directories and parameter file
+corpora = [
+	("tests/hello/hello.tmpl.txt", [], "tests/hello/hello.param"),
+	("tests/basic/basic.tmpl.txt", [], "tests/basic/basic.param"),
+	("tests/html/doc.tmpl", ["tests/html/sections"], None),
+	("tests/nest/main.tmpl", [], "tests/nest/nest.param"),
+	("tests/cpp/types.tmpl", [], "tests/cpp/types.param"),
+	("tests/cpp/rtt.tmpl", [], "tests/cpp/types.param"),
+]
+
+def load_corpus(template, includes, param_file, parser = None):
+	""" returns the made engine, the main function and its parameters """
+	engine = Engine()
+	engine.add_includes(includes)
+	path = engine.load_file(template, parser or Parser()).path
+	engine.make()
+
+	params = {}
+	if param_file:
+		with open(param_file) as f:
+			params = eval(f.read())
+
+	return engine, engine.modules[path].main, params
+
+def bench_codegen():
+	""" Reports the size of the bytecode generated for the sample templates
+	with and without write fusion.
+	"""
+	results = {}
+	for template, includes, param_file in corpora:
+		name = os.path.basename(template)
+		for optimize in (False, True):
+			parser = Parser()
+			parser.optimize = optimize
+			engine, main, params = load_corpus(template, includes, param_file, parser)
+
+			size = 0
+			for module in engine.modules.values():
+				for func in module._templates.values():
+					size += len(func.code.co_code)
+
+			results["{} {}".format(name, "fused" if optimize else "unfused")] = size
+
+	return results
+
+def bench_fusion(number = 500):
+	""" Times rendering the sample templates with and without write fusion.
+	"""
+	results = {}
+	for template, includes, param_file in corpora:
+		name = os.path.basename(template)
+		for optimize in (False, True):
+			parser = Parser()
+			parser.optimize = optimize
+			engine, main, params = load_corpus(template, includes, param_file, parser)
+
+			# the cpp samples normalize the parameters in place
+			main(**params)
+			label = "{} {}".format(name, "fused" if optimize else "unfused")
+			results[label] = best_time(lambda: main(**params), number)
+
+	return results
+
+def bench_samples(number = 100):
+	""" Times each stage of the sample templates: parsing the main file,
+	loading it with its loads, making the modules and rendering.
+	"""
+	results = {}
+	for template, includes, param_file in corpora:
+		name = os.path.basename(template)
+		with open(template) as f:
+			text = f.read()
+
+		def load():
+			engine = Engine()
+			engine.add_includes(includes)
+			engine.load_file(template)
+			return engine
+
+		engine, main, params = load_corpus(template, includes, param_file)
+		main(**params)
+
+		parser = Parser()
+		results[name + " parse"] = best_time(
+			lambda: parser.process_module(base.StringIO(text), template), number)
+		results[name + " load"] = best_time(load, number)
+		results[name + " make"] = best_time_setup(load, Engine.make, number)
+		results[name + " render"] = best_time(lambda: main(**params), number)
+
+	return results
+
+def sized_module(size):
+	""" large_template with a main template that renders all of it """
+	text = large_template(size)
+	return text + """#template main
+#{for index in range(count):
+${getattr(_module, "t" + str(index))("name", ["a", "b", "c"])}
+#}
+#end template
+#attribute count = """ + str(text.count("#end template")) + "\n"
+
+def nested_module(depth):
+	""" a chain of depth templates, each calling the next from a nested block """
+	out = base.StringIO()
+	for level in range(depth):
+		out.write("#template n{}(x)\n".format(level))
+		out.write("#{for i in range(x):\n")
+		out.write("    level {} $i\n".format(level))
+		out.write("#}\n")
+		if level + 1 < depth:
+			out.write("#{{if x:\n${{n{}(x)}}\n#}}\n".format(level + 1))
+		out.write("#end template\n")
+	return out.getvalue()
+
+def bench_scaling(sizes = (16 * 1024, 64 * 1024, 256 * 1024), depths = (8, 32, 128),
+		chains = (2, 8, 32), counts = (16, 64, 256)):
+	""" Generated corpora that scale template size, nesting depth, mixin
+	chain length and module count.
+	"""
+	results = {}
+	for size in sizes:
+		text = sized_module(size)
+		label = "size {}KB".format(size // 1024)
+
+		def load():
+			engine = Engine()
+			engine.load_text(text, "sized.tmpl")
+			return engine
+
+		engine = load()
+		engine.make()
+		main = engine.modules["sized.tmpl"].main
+		results[label + " parse"] = best_time(
+			lambda: Parser().process_module(base.StringIO(text), "sized.tmpl"), 1, 3) / 1e3
+		results[label + " make"] = best_time_setup(load, Engine.make, 1, 3) / 1e3
+		results[label + " render"] = best_time(main, 1, 3) / 1e3
+
+	for depth in depths:
+		engine = Engine()
+		engine.load_text(nested_module(depth), "nested.tmpl")
+		engine.make()
+		top = engine.modules["nested.tmpl"].n0
+		results["depth {} render".format(depth)] = best_time(lambda: top(3), 20, 3) / 1e3
+
+	for length in chains:
+		engine = Engine()
+		for index in range(length):
+			engine.load_text("#template f{0}\nf{0}\n#end template\n".format(index),
+				"m{}".format(index))
+		engine.make()
+		modules = [engine.modules["m{}".format(index)] for index in range(length)]
+		last = "f{}".format(length - 1)
+
+		def chain():
+			mixin = modules[-1]
+			for module in reversed(modules[:-1]):
+				mixin = module(mixin)
+			getattr(mixin, last)()
+
+		results["chain {} mixin call".format(length)] = best_time(chain, 200, 3) / 1e3
+
+	for count in counts:
+		directory = tempfile.mkdtemp()
+		try:
+			root = write_tree(directory, count, 4 * 1024)
+
+			def load():
+				engine = Engine()
+				engine.load_file(root)
+				return engine
+
+			results["modules {} load".format(count)] = best_time(load, 1, 3) / 1e3
+			results["modules {} make".format(count)] = best_time_setup(load, Engine.make, 1, 3) / 1e3
+		finally:
+			shutil.rmtree(directory)
+
+	return results
+
+def bench_threads(threads = (1, 2, 4, 8), renders = 4000):
+	""" Time per render of the html sample rendered with ``Engine.render``
+	from a number of threads sharing one engine.  Renders only run in
+	parallel on free-threaded Python builds.  The direct number calls the
+	main function without a render context, on one thread.
+	"""
+	engine, main, params = load_corpus("tests/html/doc.tmpl", ["tests/html/sections"], None)
+	path = main.path
+	results = {"direct" : best_time(main, renders // 10, 3)}
+
+	for count in threads:
+		def render(number):
+			for _ in range(number):
+				engine.render(path)
+
+		def run():
+			workers = [threading.Thread(target = render, args = (renders // count,))
+				for _ in range(count)]
+			for worker in workers:
+				worker.start()
+			for worker in workers:
+				worker.join()
+
+		results["{} threads".format(count)] = best_time(run, 1, 3) / renders
+
+	return results
+
+def memory_library(count):
+	""" returns a module text with count small templates, each with a loop
+	and a few placeholders
+	"""
+	out = base.StringIO()
+	for index in range(count):
+		out.write("#template t{0}(name, items)\n// $name {0}\n#{{for item in items:\n"
+			"    ${{item}}_{0} = ${{len(item)}},\n#}}\n#end template\n".format(index))
+	return out.getvalue()
+
+def bench_memory(count = 10000, mixins = 10):
+	""" Memory traced while loading and making a library of count templates,
+	and while creating mixins of it that bind every function.
+	"""
+	text = memory_library(count)
+	engine = Engine()
+	engine.load_text("#attribute x = 1\n", "other.tmpl")
+
+	tracemalloc.start()
+	try:
+		start = tracemalloc.get_traced_memory()[0]
+		engine.load_text(text, "lib.tmpl")
+		loaded = tracemalloc.get_traced_memory()[0]
+		engine.make()
+		made = tracemalloc.get_traced_memory()[0]
+
+		lib = engine.modules["lib.tmpl"]
+		other = engine.modules["other.tmpl"]
+		mixed = [lib(other) for _ in range(mixins)]
+		for mixin in mixed:
+			for name in lib._templates:
+				getattr(mixin, name)
+		bound = tracemalloc.get_traced_memory()[0]
+	finally:
+		tracemalloc.stop()
+
+	megabyte = 1024.0 * 1024
+	return {
+		"load" : (loaded - start) / megabyte,
+		"make" : (made - loaded) / megabyte,
+		"{} bound mixins".format(mixins) : (bound - made) / megabyte,
+	}
+
+def report(title, results, unit = "us"):
+	print(title)
+	for name, value in results.items():
+		if isinstance(value, int):
+			print("    {:<36} {:10d} {}".format(name, value, unit))
+		else:
+			print("    {:<36} {:10.3f} {}".format(name, value, unit))
+
+# units of the suites that measure sizes rather than times
+size_units = ("bytes", "MB")
+
+def compare(results, baseline, threshold = 0.1):
+	""" Prints the results next to the baseline results, marking changes
+	larger than threshold (a fraction).  Lower values are better for all
+	benchmarks.  Suites measured in a different unit than the baseline are
+	skipped.
+	"""
+	print("compared to baseline")
+	for suite, current in results.items():
+		previous = baseline.get(suite)
+		if not previous:
+			continue
+
+		unit = current["unit"]
+		print(current["title"])
+		if previous.get("unit") != unit:
+			print("    skipped, the baseline is in {}, not {}".format(previous.get("unit"), unit))
+			continue
+
+		worse, better = ("larger", "smaller") if unit in size_units else ("slower", "faster")
+		for name, value in current["values"].items():
+			base_value = previous["values"].get(name)
+			if not base_value:
+				continue
+
+			change = value / base_value - 1
+			mark = ""
+			if change > threshold:
+				mark = worse
+			elif change < -threshold:
+				mark = better
+			print("    {:<36} {:10.3f} {:10.3f} {} {:+7.1f}% {}".format(
+				name, base_value, value, unit, change * 100, mark))
+
+# name, title, function and unit of the suites
+suites = [
+	("call", "template call", bench_call, "us"),
+	("mixin", "mixin creation", bench_mixin, "us"),
+	("samples", "sample templates", bench_samples, "us"),
+	("scaling", "generated corpora", bench_scaling, "ms"),
+	("parse", "parse 2MB", bench_parse, "ms"),
+	("load", "load 64 modules of 64KB", bench_load, "ms"),
+	("lazy", "render 1 of 5000 library templates", bench_lazy, "ms"),
+	("serve", "render latency", bench_serve, "ms"),
+	("codegen", "generated bytecode size", bench_codegen, "bytes"),
+	("fusion", "sample renders with and without write fusion", bench_fusion, "us"),
+	("threads", "concurrent renders, time per render", bench_threads, "us"),
+	("memory", "memory of 10000 templates", bench_memory, "MB"),
+]
+
+def run(names = None):
+	""" Runs the suites in names (all by default) and reports the results
+	as they finish.
+
+	:rtype: dictionary of suite name to title, unit and values
+	"""
+	results = {}
+	for name, title, func, unit in suites:
+		if names and name not in names:
+			continue
+
+		values = func()
+		report(title, values, unit)
+		results[name] = {"title" : title, "unit" : unit, "values" : values}
+
+	return results
+
+if __name__ == "__main__":
+	arg_parser = argparse.ArgumentParser(prog = "python -m texthon.benchmark",
+		description = "Runs the texthon benchmarks")
+	arg_parser.add_argument("suite", nargs = "*",
+		help = "the suites to run, all by default: " + ", ".join(suite[0] for suite in suites))
+	arg_parser.add_argument("--json", default = None, help = "save the results to a json file")
+	arg_parser.add_argument("--baseline", default = None, help = "compare with results saved before")
+	arg_parser.add_argument("--threshold", type = float, default = 10,
+		help = "percentage of change to mark, 10 by default")
+	args = arg_parser.parse_args()
+	unknown = set(args.suite).difference(suite[0] for suite in suites)
+	if unknown:
+		arg_parser.error("unknown suites " + ", ".join(sorted(unknown)))
+
+	results = run(args.suite)
+
+	if args.json:
+		with open(args.json, "w") as f:
+			json.dump({"python" : sys.version, "results" : results}, f, indent = 1)
+
+	if args.baseline:
+		with open(args.baseline) as f:
+			compare(results, json.load(f)["results"], args.threshold / 100)
@@ -0,0 +1,107 @@
+# Copyright 2013 Kevin Lin
+# Licensed under the Apache License, Version 2.0
+
+import os
+import sys
+import hashlib
+import pickle
+import tempfile
+
+class Module_Cache:
+	""" On-disk cache of parsed and compiled template modules, similar in
+	spirit to ``__pycache__``.
+
+	Each entry stores a module definition together with the compiled code of
+	its template functions.  Entries are keyed by the source path and the
+	parser settings, and are validated against the source file's
+	modification time, size and content hash.
+
+	:param directory: the directory to store cache entries in
+	"""
+
+	# bump whenever the layout of the stored definitions changes
+	version = 6
+
+	def __init__(self, directory):
+		self.directory = directory
+		self.hits = 0
+		self.misses = 0
+
+	def _parser_key(self, parser):
+		kind, directive_token, placeholder, optimize = parser.signature()
+		return "{}:{}:{}:{}".format(kind.__name__, directive_token, placeholder, optimize)
+
+	def _entry_path(self, path, parser):
+		key = "{}|{}|{}|{}".format(self.version, sys.version,
+			self._parser_key(parser), path)
+		digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+		name = "{}.{}.tmplc".format(os.path.basename(path), digest[:16])
+		return os.path.join(self.directory, name)
+
+	def _hash(self, text):
+		return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+	def _read_entry(self, entry_path):
+		try:
+			with open(entry_path, "rb") as f:
+				return pickle.load(f)
+		except Exception:
+			# missing, truncated or written by an incompatible version
+			return None
+
+	def _write_entry(self, entry_path, entry):
+		# the parallel loader may get here from several threads
+		os.makedirs(self.directory, exist_ok = True)
+
+		# write to a temporary file first so readers never see partial entries
+		fd, temp_path = tempfile.mkstemp(dir = self.directory)
+		try:
+			with os.fdopen(fd, "wb") as f:
+				pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+			os.replace(temp_path, entry_path)
+		except Exception:
+			os.remove(temp_path)
+			raise
+
+	def load(self, path, parser):
+		""" Returns the cached module definition for the file at ``path``
+		parsed with ``parser``, or None if there's no valid entry.
+		"""
+		entry_path = self._entry_path(path, parser)
+		entry = self._read_entry(entry_path)
+		if entry is None or entry.get("path") != path:
+			self.misses += 1
+			return None
+
+		stat = os.stat(path)
+		if entry["mtime"] != stat.st_mtime_ns or entry["size"] != stat.st_size:
+			# the file was touched, fall back to comparing content
+			with open(path) as f:
+				text = f.read()
+
+			if entry["hash"] != self._hash(text):
+				self.misses += 1
+				return None
+
+			entry["mtime"] = stat.st_mtime_ns
+			entry["size"] = stat.st_size
+			self._write_entry(entry_path, entry)
+
+		self.hits += 1
+		return entry["module"]
+
+	def store(self, path, parser, module, text, stat):
+		""" Stores a module definition parsed from ``text``, the content of
+		the file at ``path``.  Template code of the module is expected to be
+		compiled already.
+
+		:param stat: result of ``os.stat`` taken before ``text`` was read
+		"""
+		entry = {
+			"path" : path,
+			"mtime" : stat.st_mtime_ns,
+			"size" : stat.st_size,
+			"hash" : self._hash(text),
+			"module" : module,
+		}
+		self._write_entry(self._entry_path(path, parser), entry)
@@ -2,49 +2,389 @@
 # Licensed under the Apache License, Version 2.0
 
 from .parser import Parser
+from .cache import Module_Cache
+from .profiler import Profiler
 from . import base
 from . import utils
 import io
 import os
 import sys
 import importlib
+import importlib.util
 import traceback
 import copy
-import collections
+import types
+import weakref
 import linecache
+import time
+import collections
+import asyncio
+import contextlib
+import threading
+import concurrent.futures
+import multiprocessing
 
 class Exec_Exception(Exception):
-	def __init__(self, func, msg):
+	def __init__(self, func, msg, traceback = ""):
 		self.path = func.path
 		self.name = func.name
 		self.line = func.definition_line
 		self.msg = msg
+		# the traceback with template source lines printed for the error
+		self.traceback = traceback
 
 	def __str__(self):
 		return "{}:{}({}) has thrown an exception: {}".format(
 			self.path, self.name, self.line, self.msg)
 
+class Output(base.StringIO):
+	""" Output stream the template functions write to, available to templates
+	as ``_output``.
+	"""
+
+	# output of deferred async calls, see defer
+	segments = None
+	# (utils.Indent, columns, position, line state) of the pushed indent
+	# levels, see push_indent
+	indents = None
+	# column of the whitespace read at the start of the current line, None
+	# past the start of a line
+	line_column = None
+	# columns added to the current line
+	line_offset = 0
+	# the Output_Set of the render, see outputs
+	_outputs = None
+
+	@property
+	def outputs(self):
+		""" The named outputs of the render, available to templates as
+		``_outputs``.  Every stream of a render shares the same set.
+		"""
+		if self._outputs is None:
+			self._outputs = Output_Set()
+		return self._outputs
+
+	def call(self, func, /, *args, **kwargs):
+		""" Calls ``func`` and writes the result to the stream.  Template
+		functions are rendered directly into the stream instead of returning
+		an intermediate string.  Async template functions are deferred.
+		"""
+		if isinstance(func, Template_Function):
+			if func.is_async:
+				self.defer(func, args, kwargs)
+			else:
+				func.render(self, args, kwargs)
+		else:
+			self.write(str(func(*args, **kwargs)))
+
+	def push_indent(self, level = 1, indent = None):
+		""" Indents the text written from here on by ``level`` more levels of
+		``indent``, a ``utils.Indent`` that defaults to the one pushed
+		before.  Lines are indented as they are written, the same way
+		``Indent.indent`` indents a block: the leading whitespace of a line
+		is replaced with tabs or spaces up to its new column.  The text
+		written after the push counts as the start of a line.
+		"""
+		state = (self.line_column, self.line_offset)
+		if self.indents is None:
+			self.indents = []
+			self.line_column = 0
+			self.line_offset = 0
+			self.write = self._write_indented
+		elif self.line_column is None:
+			# only the new level applies to the rest of a line
+			self.line_column = 0
+			self.line_offset = 0
+
+		if indent is None:
+			indent = self.indents[-1][0] if self.indents else utils.Indent()
+
+		columns = level * indent.cols
+		total = self.indents[-1][1] + columns if self.indents else columns
+		self.indents.append((indent, total, self.tell(), state))
+		self.line_offset += columns
+
+	def pop_indent(self):
+		""" Removes the indent levels added by the last ``push_indent`` """
+		if not self.indents:
+			raise ValueError("no indent to pop")
+
+		if self.line_column:
+			# whitespace at the end of the block still gets indented
+			self._write_prefix()
+			self.line_column = None
+
+		_, _, position, state = self.indents.pop()
+		if self.line_column == 0 and self.tell() == position:
+			# nothing was written, the line goes on as before
+			self.line_column, self.line_offset = state
+		elif self.indents and self.line_column is not None:
+			self.line_offset = self.indents[-1][1]
+
+		if not self.indents:
+			self.indents = None
+			del self.write
+
+	@contextlib.contextmanager
+	def indented(self, level = 1, indent = None):
+		""" Context manager pushing indent levels for the text written in
+		its body, see ``push_indent``
+		"""
+		self.push_indent(level, indent)
+		try:
+			yield self
+		finally:
+			self.pop_indent()
+
+	def _write_prefix(self):
+		# the outermost indent decides between tabs and spaces
+		prefix = self.indents[0][0].set_column("", self.line_column + self.line_offset)
+		base.StringIO.write(self, prefix)
+
+	def _write_indented(self, text):
+		write = base.StringIO.write
+		position = 0
+		end = len(text)
+		while position < end:
+			if self.line_column is not None:
+				cols = self.indents[0][0].cols
+				column = self.line_column
+				while position < end and text[position] in " \t":
+					column += 1 if text[position] == " " else cols
+					position += 1
+
+				self.line_column = column
+				if position == end:
+					break
+
+				self._write_prefix()
+				self.line_column = None
+
+			newline = text.find("\n", position) + 1
+			if newline == 0:
+				write(self, text[position:])
+				break
+
+			write(self, text[position:newline])
+			position = newline
+			self.line_column = 0
+			self.line_offset = self.indents[-1][1]
+
+		return end
+
+	def defer(self, func, args, kwargs):
+		""" Starts rendering an async template function as a task of the
+		running event loop.  Its output is put in at the current position by
+		``resolve``, so calls run concurrently and keep their order.
+		"""
+		try:
+			loop = asyncio.get_running_loop()
+		except RuntimeError:
+			raise Exec_Exception(func, "async templates have to be rendered with render_async")
+
+		child = Output()
+		child._outputs = self.outputs
+		if self.indents:
+			# the call is indented like text written here.  the positions
+			# are cleared, the call counts as written text for pop_indent.
+			self.indents = [(indent, total, -1, state)
+				for indent, total, position, state in self.indents]
+			child.indents = list(self.indents)
+			child.line_column = self.line_column
+			child.line_offset = self.line_offset
+			child.write = child._write_indented
+			# assume the call writes text on the line, resolve puts in the
+			# indent of the next line if it ends a line instead
+			self.line_column = None
+		child.task = loop.create_task(func._render_async(child, args, kwargs))
+
+		if self.segments is None:
+			self.segments = []
+		self.segments.append(self.getvalue())
+		self.segments.append(child)
+		self.seek(0)
+		self.truncate()
+
+	async def resolve(self):
+		""" Waits for the deferred calls and puts their output in place """
+		segments = self.segments
+		if not segments:
+			return
+
+		self.segments = None
+		tasks = [segment.task for segment in segments if isinstance(segment, Output)]
+		try:
+			await asyncio.gather(*tasks)
+		except BaseException:
+			for task in tasks:
+				task.cancel()
+			raise
+
+		# the text is indented already
+		write = base.StringIO.write
+		segments.append(self.getvalue())
+		self.seek(0)
+		self.truncate()
+		for index, segment in enumerate(segments):
+			if isinstance(segment, str):
+				write(self, segment)
+				continue
+
+			write(self, segment.getvalue())
+			# a call that ends at the start of a line leaves the indent of
+			# the text after it to write
+			following = segments[index + 1]
+			if segment.indents and segment.line_column is not None and following[:1] not in ("", "\n"):
+				column = segment.line_column + segment.line_offset
+				write(self, segment.indents[0][0].set_column("", column))
+
+class Output_Set(dict):
+	""" Named output streams of a render, created on first use.  Templates
+	render into one with its ``call`` method::
+
+		#! _outputs[name + ".h"].call(header, type)
+	"""
+
+	def __missing__(self, name):
+		output = self[name] = Output()
+		output._outputs = self
+		return output
+
 class Template_Function:
 	""" Compiled template function object.  Returns a string that's the result
 	of the template evaluation
 	
-	The callable object takes a variable number of arguments, but it will
-	perform additional checks against the declared parameters of the
-	template function definition.
+	The template body is compiled into a real Python function that takes the
+	declared parameters as arguments.  Its globals are the attribute
+	dictionary of the owning module, so module attributes are always seen
+	up to date.
+
+	Copies made by ``rebind`` share the text, code and line map with the
+	function they are copied from, and the memoized outputs, which are keyed
+	on the module the copy is bound to as well as the arguments.
 	"""
 
+	__slots__ = ("name", "text", "code", "function", "varargs", "params", "module",
+		"definition_line", "path", "source_lines", "dependencies", "definition",
+		"cache_size", "memo", "stats", "profiler", "is_async", "template_function",
+		"profiled_function", "defaults")
+
 	def __init__(self):
 		self.name = ""
 		self.text = []
 		self.code = None
+		self.function = None
 		self.varargs = False
 		self.params = []
 		self.module = None
 		self.definition_line = 0
 		self.path = ""
 		self.source_lines = []
-
-	def _print_exception(self, e):
+		# names of other templates in the module the code refers to
+		self.dependencies = []
+		# the definition to compile on first call, in lazy mode
+		self.definition = None
+		# outputs to memoize, see _memo_call
+		self.cache_size = 0
+		self.memo = None
+		self.stats = None
+		self.profiler = None
+		self.is_async = False
+		# the functions the memo and profile wrappers call
+		self.template_function = None
+		self.profiled_function = None
+		# keyword defaults of the function, shared by the rebound copies
+		self.defaults = None
+
+	def bind(self, module):
+		""" Binds the function to ``module``, which provides the globals
+		for the template code.
+		"""
+		self.module = module
+		if self.code is None:
+			self.function = self._compile_call
+			return
+
+		self.function = types.FunctionType(self.code, module.__dict__, self.name)
+		if self.defaults is None:
+			self.defaults = {"_textdb" : self.text}
+		self.function.__kwdefaults__ = self.defaults
+
+		# the wrappers render synchronously, async templates go without
+		if self.is_async:
+			return
+
+		if self.cache_size:
+			self.template_function = self.function
+			self.function = self._memo_call
+
+		if self.profiler:
+			self.profiled_function = self.function
+			self.function = self._profile_call
+
+	def _profile_call(self, *args, _output, **kwargs):
+		self.profiler.call(self, self.profiled_function, args, _output, kwargs)
+
+	def _memo_call(self, *args, _output, **kwargs):
+		# outputs are keyed on the module, whose attributes the template
+		# sees (render context copies share the outputs of the original),
+		# and on the arguments and their types, as 1 and 1.0 are equal but
+		# render differently.  unhashable arguments render without the cache.
+		key = (self.module._origin, args, tuple(map(type, args)))
+		if kwargs:
+			items = sorted(kwargs.items())
+			key += (tuple(items), tuple(type(value) for name, value in items))
+
+		stats = self.stats
+		try:
+			text = self.memo.get(key)
+		except TypeError:
+			stats["uncacheable"] += 1
+			return self.template_function(*args, _output = _output, **kwargs)
+
+		# renders on other threads may evict entries at any point
+		memo = self.memo
+		if text is None:
+			stats["misses"] += 1
+			output = Output()
+			self.template_function(*args, _output = output, **kwargs)
+			text = output.getvalue()
+			memo[key] = text
+			while len(memo) > self.cache_size:
+				try:
+					memo.popitem(last = False)
+				except KeyError:
+					break
+		else:
+			stats["hits"] += 1
+			try:
+				memo.move_to_end(key)
+			except KeyError:
+				pass
+
+		_output.write(text)
+
+	def _compile_call(self, *args, **kwargs):
+		# stands in for the function until its first call, then compiles and
+		# binds the code along with the templates it refers to
+		definition = self.definition
+		if definition.compiled is None:
+			_compile_template(definition, self.path)
+
+		module = self.module
+		prototype = module._templates.get(self.name, self)
+		prototype.code = self.code = definition.compiled
+		prototype.dependencies = self.dependencies = sorted(
+			_code_names(self.code).intersection(module._templates))
+
+		self.bind(module)
+		for name in self.dependencies:
+			if name not in module.__dict__:
+				module._bind(name)
+
+		return self.function(*args, **kwargs)
+
+	def _format_exception(self, e):
 		exc_type, exc_value, exc_traceback = sys.exc_info()
 
 		def trans(frame):
@@ -59,122 +399,479 @@ class Template_Function:
 		# skip the exec frame
 		tb = map(trans, traceback.extract_tb(exc_traceback)[1:])
 
-		sys.stderr.write("Traceback with template source lines:\n")
-		msg = traceback.format_list(tb)
-		sys.stderr.write("".join(msg))
+		text = ["Traceback with template source lines:\n"]
+		text.extend(traceback.format_list(tb))
+		text.append("------\n")
+		text.extend(traceback.format_exception_only(type(e), e))
+		text.append("\n")
+		return "".join(text)
 
-		sys.stderr.write("------\n")
+	def rebind(self, module):
+		""" Returns a copy of the function bound to ``module`` """
+		if self.defaults is None:
+			self.defaults = {"_textdb" : self.text}
+		if self.cache_size and self.memo is None:
+			self.memo = collections.OrderedDict()
+
+		result = Template_Function.__new__(Template_Function)
+		result.name = self.name
+		result.text = self.text
+		result.code = self.code
+		result.varargs = self.varargs
+		result.params = self.params
+		result.definition_line = self.definition_line
+		result.path = self.path
+		result.source_lines = self.source_lines
+		result.dependencies = self.dependencies
+		result.definition = self.definition
+		result.cache_size = self.cache_size
+		result.memo = self.memo
+		result.stats = self.stats
+		result.profiler = self.profiler
+		result.is_async = self.is_async
+		result.template_function = None
+		result.profiled_function = None
+		result.defaults = self.defaults
+		result.bind(module)
+		return result
 
-		msg = traceback.format_exception_only(type(e), e)
-		sys.stderr.write("".join(msg))
+	def _translate_exception(self, e):
+		tb = sys.exc_info()[2]
+		while tb.tb_next and tb.tb_next.tb_frame.f_code in _wrapper_codes:
+			tb = tb.tb_next
 
-		sys.stderr.write("\n")
+		# no template frame means the arguments didn't match the params
+		if isinstance(e, TypeError) and tb.tb_next is None:
+			return Exec_Exception(self, str(e))
 
-	def rebind(self, module):
-		result = copy.copy(self)
-		result.module = module
-		return result
+		text = self._format_exception(e)
+		sys.stderr.write(text)
+		# errors of nested calls were printed first
+		if isinstance(e, Exec_Exception):
+			text = e.traceback + text
+		return Exec_Exception(self, "execution aborted", text)
 
 	def __call__(self, *args, **kwargs):
-		output = base.StringIO()
-
-		local_vars = {
-			"_module" : self.module,
-			"_textdb" : self.text,
-			"_output" : output,
-		}
-			
-		# bind arguments
-		if not self.varargs:
-			arg_count = len(args)
-			arg_index = 0
-			for param in self.params:
-				if arg_index < arg_count:
-					local_vars[param] = args[arg_index]
-					arg_index += 1
-					if param in kwargs:
-						raise Exec_Exception(self, "template param {} already bound".format(param))
-				else:
-					if param in kwargs:
-						local_vars[param] = kwargs[param]
-					else:
-						raise Exec_Exception(self, "unbound template param {}".format(param))
-
-			if arg_index < arg_count:
-				raise Exec_Exception(self, "too many arguments in template call")
-		else:
-			local_vars["_args"] = args
-			local_vars["_kwargs"] = kwargs
+		if self.is_async:
+			return self.render_async(*args, **kwargs)
 
+		output = Output()
 		exception = None
 
 		try:
-			global_vars = dict(self.module.__dict__)
-			global_vars.update(local_vars)
-			exec(self.code, global_vars, local_vars)
+			self.function(*args, _output = output, **kwargs)
 		except Exception as e:
-			self._print_exception(e)
-			exception = e
+			exception = self._translate_exception(e)
 
 		if exception:
-			raise Exec_Exception(self, "execution aborted")
+			raise exception
+		if output.segments:
+			raise Exec_Exception(self, "templates calling async templates have to be rendered with render_async")
+		if output._outputs:
+			raise Exec_Exception(self, "templates writing named outputs have to be rendered with render_outputs")
 
 		return output.getvalue()
 
+	def render_outputs(self, *args, **kwargs):
+		""" Evaluates the template like calling it does, and also returns the
+		text of the named outputs it wrote to.
+
+		:rtype: (result, dictionary of output name to text)
+		"""
+		output = Output()
+		self.render(output, args, kwargs)
+		if output.segments:
+			raise Exec_Exception(self, "templates calling async templates have to be rendered with render_async")
+
+		outputs = {name : stream.getvalue() for name, stream in output.outputs.items()}
+		return output.getvalue(), outputs
+
+	async def render_async(self, *args, **kwargs):
+		""" Evaluates the template on the running event loop and returns
+		the result.  Async template functions called by placeholders run
+		concurrently.
+		"""
+		output = Output()
+		await self._render_async(output, args, kwargs)
+		return output.getvalue()
+
+	async def _render_async(self, output, args, kwargs):
+		exception = None
+
+		try:
+			result = self.function(*args, _output = output, **kwargs)
+			if self.is_async:
+				await result
+		except Exception as e:
+			exception = self._translate_exception(e)
+
+		if exception:
+			raise exception
+
+		await output.resolve()
+
+	def render(self, output, args, kwargs):
+		""" Evaluates the template, writing the result to ``output`` """
+		exception = None
+
+		try:
+			self.function(*args, _output = output, **kwargs)
+		except Exception as e:
+			exception = self._translate_exception(e)
+
+		if exception:
+			raise exception
+
+# frames that stand between a template call and the template code
+_wrapper_codes = (Template_Function._compile_call.__code__, Template_Function._memo_call.__code__,
+	Template_Function._profile_call.__code__, Profiler.call.__code__)
+
+def _merge(sequences):
+	# C3 merge of linearizations
+	result = []
+	sequences = [list(seq) for seq in sequences if seq]
+	while sequences:
+		for seq in sequences:
+			head = seq[0]
+			if not any(head in other[1:] for other in sequences):
+				break
+		else:
+			raise TypeError("Cannot create a consistent lookup order for template module mixins")
+
+		result.append(head)
+		for seq in sequences:
+			if seq[0] is head:
+				del seq[0]
+		sequences = [seq for seq in sequences if seq]
+
+	return result
+
+def _code_names(code):
+	# global and attribute names referred to by code, including nested code
+	names = set(code.co_names)
+	for const in code.co_consts:
+		if isinstance(const, types.CodeType):
+			names |= _code_names(const)
+	return names
+
+def _linearize(module, visiting):
+	if id(module) in visiting:
+		raise TypeError("Loop in template module base chain")
+
+	visiting.add(id(module))
+	bases = module._base
+	result = [module] + _merge([_linearize(base, visiting) for base in bases] + [bases])
+	visiting.discard(id(module))
+	return result
+
 class Template_Module:
 	""" Provides access to template functions as attributes.  It's also a
 	callable object that returns a shallow copy of itself on return.
 
-	Call this object with a list of modules to create mixins.
+	Call this object with a list of modules to create mixins.  Attributes
+	that aren't defined by the mixin itself are looked up in its bases, in
+	C3 order (the same as Python classes).  The order is computed when the
+	mixin is created, and the lookups are cached until a base module's
+	attribute is assigned.
+
+	Template functions are bound to a module on first access, together with
+	the other templates their code refers to, so creating a mixin costs the
+	same no matter how many templates the module defines.
 	"""
-	def __init__(self):
-		self._base = []
 
-	def __call__(self, *args):
-		instance = copy.copy(self)
-		instance._base.extend(args)
+	# number of mixin layouts remembered per module
+	layout_cache_size = 64
 
-		# rebind all template functions
-		functions = {}
-		for name, attr in instance.__dict__.items():
-			if isinstance(attr, Template_Function):
-				functions[name] = attr.rebind(instance)
+	def __init__(self):
+		self.__dict__.update({
+			"_base" : [],
+			"_mro" : [],
+			"_resolved" : {},
+			"_dependents" : weakref.WeakSet(),
+			"_templates" : {},
+			"_bound" : set(),
+			"_layouts" : {},
+			# the module the template code runs in, as a global
+			"_module" : self,
+			# the module memoized outputs are keyed on, see Render_Context
+			"_origin" : self,
+		})
+
+	def _reset(self):
+		# empty the module in place so it can be made again, the attribute
+		# dict is the globals of functions that are already bound
+		attributes = self.__dict__
+		templates = attributes["_templates"]
+		dependents = attributes["_dependents"]
+		attributes.clear()
+		templates.clear()
+		Template_Module.__init__(self)
+		attributes["_templates"] = templates
+		attributes["_dependents"] = dependents
+
+		for dependent in dependents:
+			dependent._resolved.clear()
+
+	def _layout(self, args):
+		# mixins with the same bases share the same lookup order
+		key = tuple(map(id, args))
+		layout = self._layouts.get(key)
+		if layout:
+			return layout[1], layout[2]
+
+		bases = list(self._base)
+		for base in args:
+			if not any(base is existing for existing in bases):
+				bases.append(base)
+
+		visiting = set()
+		mro = _merge([_linearize(base, visiting) for base in bases] + [bases])
+		for base in mro:
+			base._load()
+
+		if len(self._layouts) >= self.layout_cache_size:
+			self._layouts.clear()
+		# keep args alive so their ids stay valid for the key
+		self._layouts[key] = (args, bases, mro)
+		return bases, mro
+
+	def _load(self):
+		# modules loaded lazily are filled in on first use
+		loader = self.__dict__.get("_loader")
+		if loader:
+			loader()
 
-		instance.__dict__.update(functions)
+	def __call__(self, *args):
+		instance = Template_Module.__new__(Template_Module)
+		self._mix(instance, args)
 		return instance
 
+	def _mix(self, instance, args):
+		# makes instance a mixin of this module and args
+		self._load()
+		bases, mro = self._layout(args)
+
+		# copy on write: functions bound to this module are left out, the
+		# instance binds its own copies when they're accessed
+		attributes = dict(self.__dict__)
+		for name in self._bound:
+			del attributes[name]
+
+		attributes.update({
+			"_base" : list(bases),
+			"_mro" : mro,
+			"_resolved" : {},
+			"_dependents" : weakref.WeakSet(),
+			"_bound" : set(),
+			"_layouts" : {},
+			"_module" : instance,
+			"_origin" : instance,
+		})
+
+		object.__setattr__(instance, "__dict__", attributes)
+
+		for base in mro:
+			base._dependents.add(instance)
+
+	def _bind(self, name):
+		attributes = self.__dict__
+		templates = attributes["_templates"]
+		bound = attributes["_bound"]
+
+		# bind the templates the code refers to as well, they're looked up
+		# as globals which bypass __getattr__
+		pending = [name]
+		while pending:
+			current = pending.pop()
+			if current in attributes:
+				continue
+
+			func = templates[current].rebind(self)
+			attributes[current] = func
+			bound.add(current)
+			pending.extend(func.dependencies)
+
+		return attributes[name]
+
+	def _invalidate(self, name):
+		self._bound.discard(name)
+		self._resolved.pop(name, None)
+		for dependent in self._dependents:
+			dependent._resolved.pop(name, None)
+
+	def __setattr__(self, name, value):
+		if "_loader" in self.__dict__:
+			self._load()
+		self.__dict__[name] = value
+		self._invalidate(name)
+
+	def __delattr__(self, name):
+		object.__delattr__(self, name)
+		self._invalidate(name)
+
 	def __getattr__(self, name):
-		if "_base" not in self.__dict__:
-			raise AttributeError("")
+		attributes = self.__dict__
+		if "_resolved" not in attributes:
+			raise AttributeError(name)
+
+		if name in attributes["_templates"]:
+			return self._bind(name)
+
+		resolved = attributes["_resolved"]
+		if name in resolved:
+			return resolved[name]
+
+		for base in attributes["_mro"]:
+			base_attributes = base.__dict__
+			if name in base_attributes:
+				value = base_attributes[name]
+			elif name in base_attributes["_templates"]:
+				value = base._bind(name)
+			else:
+				continue
 
-		visit = collections.deque(self._base)
-		count = 0
-		while visit:
-			current = visit.popleft()
-			visit.extendleft(current._base)
-			if name in current.__dict__:
-				return current.__dict__[name]
-
-			count += 1
-			# sanity check for loops in the hierarchy
-			if count > 100:
-				msg = "Failed to lookup attribute {} in template module: possible loop in base chain".format(
-					name)
-				raise AttributeError(msg)
+			resolved[name] = value
+			return value
+
+		if "_loader" in attributes:
+			self._load()
+			return getattr(self, name)
 
 		msg = "Attribute {} not found in template module".format(name)
 		raise AttributeError(msg)
 
+class Render_Context:
+	""" Copies of made modules for one render, so that renders running
+	concurrently on threads don't see each other's changes to module
+	attributes.  The modules of the engine are left alone, and can be
+	shared by any number of contexts.
+
+	A module is copied the first time it's asked for, together with every
+	module reachable through its attributes, such as the modules it loads.
+	Attributes referring to copied modules are pointed at the copies.
+	Copies are made like mixins, so they bind template functions lazily and
+	cost about the same no matter how many templates the modules define.
+	Mixins held by attributes are copied with their bases, so templates
+	of a base run in the context's copy of it.  Modules deferred by lazy
+	mode are copied once they're first used, so copying doesn't load them.
+	Copies share the memoized outputs of the modules they're copied from.
+
+	Values that aren't modules are shared; templates mutating lists or
+	dictionaries held by module attributes still affect other renders.
+
+	:param modules: dictionary of path to made module
+	:param lock: held while copying, so a module isn't copied while it's
+		made; the engine's lock when deferred modules are made on first use
+	"""
+
+	def __init__(self, modules, lock = None):
+		self.modules = modules
+		self.lock = lock or contextlib.nullcontext()
+		# id of an original module -> (original, copy)
+		self.copies = {}
+
+	def module(self, path):
+		""" Returns this context's copy of the module at ``path`` """
+		return self._copy(self.modules[path])
+
+	def _copy(self, module):
+		entry = self.copies.get(id(module))
+		if entry:
+			return entry[1]
+
+		copy = Template_Module()
+		self.copies[id(module)] = (module, copy)
+		if "_loader" in module.__dict__:
+			copy.__dict__["_loader"] = lambda: self._fill(module, copy)
+		else:
+			self._fill(module, copy)
+		return copy
+
+	def _fill(self, module, copy):
+		with self.lock:
+			module._mix(copy, ())
+			attributes = copy.__dict__
+			attributes["_origin"] = module._origin
+			for name, value in list(attributes.items()):
+				if isinstance(value, Template_Module) and name not in ("_module", "_origin"):
+					attributes[name] = self._copy(value)
+
+			# look attributes up in the copies of the bases
+			attributes["_base"] = [self._copy(base) for base in attributes["_base"]]
+			attributes["_mro"] = [self._copy(base) for base in attributes["_mro"]]
+			for base in attributes["_mro"]:
+				base._load()
+				base._dependents.add(copy)
+
+def _compile_template(func_definition, path):
+	# compile with error translation
+	try:
+		code = compile(func_definition.code, path, "exec")
+	except SyntaxError as e:
+		e.lineno = func_definition.source_lines[e.lineno - 1]
+		raise e
+
+	# keep the code of the function the definition compiles into
+	for const in code.co_consts:
+		if isinstance(const, types.CodeType):
+			func_definition.compiled = const
+
+def _compile_definition(mod_definition):
+	for func_definition in mod_definition.templates.values():
+		if func_definition.compiled is None:
+			_compile_template(func_definition, mod_definition.path)
+
+def _parse_file(parser, path, text):
+	# runs in a worker process of the parallel loader
+	module = parser.process_module(base.StringIO(text), path)
+	module.path = path
+	try:
+		_compile_definition(module)
+	except SyntaxError:
+		# leave the error to make(), like the serial path does
+		pass
+	return module
+
+# the engine forked render workers inherit
+_render_engine = None
+
+def _render_job(job):
+	return _render_engine._render_job(*job)
+
 class Engine:
 	""" Primary entrance for the Texthon library.  This provides methods
 	to load, compile, and evaluate templates.
 
 	Use the ``modules`` attribute (dict) to locate compiled or parsed modules.
+	The parsed module definitions stay available in ``definitions``.
 	"""
 	def __init__(self):
 		self.modules = {}
+		self.definitions = {}
 		self.paths = []
 		self.verbose = False
+		self.cache = None
+		# path -> (parser, (mtime, size)) of modules loaded from files
+		self.sources = {}
+		# path -> paths of the modules that load it
+		self.dependents = {}
+		self.runtime_modules = {}
+		# paths of the definitions that need to be (re)made
+		self.pending = set()
+		self.parallel = None
+		self.lazy = False
+		# path -> parser of loaded modules that aren't loaded yet in lazy mode
+		self.deferred = {}
+		# directory -> names of its entries, to resolve load paths with
+		self.listings = {}
+		self.resolve_stats = {"loads" : 0, "listings" : 0, "time" : 0.0}
+		# memoized template calls, see Template_Function
+		self.memo_stats = {"hits" : 0, "misses" : 0, "uncacheable" : 0}
+		self.profiler = None
+		# (path, parser signature) -> files read ahead by the parallel loader
+		self._prefetched = None
+		# held while modules deferred by lazy mode are loaded by renders
+		self.lock = threading.RLock()
 
 	def trace(self, text):
 		if self.verbose:
@@ -188,25 +885,96 @@ class Engine:
 		""" Set to true for additional debug output. """
 		self.verbose = verbose
 
+	def set_cache(self, directory):
+		""" Enable the on-disk module cache.  Parsed and compiled modules are
+		stored in ``directory`` and reused by later ``load_file`` calls as long
+		as the source file and the parser settings are unchanged.
+		"""
+		self.cache = Module_Cache(directory) if directory else None
+
+	def set_profiler(self, profiler):
+		""" Record the calls of template functions with ``profiler`` (a
+		``texthon.profiler.Profiler``), or stop recording with None.  Applies
+		to the modules made after the call.
+		"""
+		self.profiler = profiler
+
+	def set_lazy(self, lazy):
+		""" Enable lazy mode.  Modules referred to by load directives are
+		loaded and made when one of their attributes is first used, and
+		template functions are compiled on their first call.
+		"""
+		self.lazy = lazy
+
+	def set_parallel(self, threads, processes = 0, process_threshold = 256 * 1024):
+		""" Enable parallel loading.  ``load_file`` then discovers the loaded
+		modules breadth first and reads and parses them with a pool of
+		``threads`` threads.  Files larger than ``process_threshold`` bytes are
+		parsed in a pool of ``processes`` worker processes instead.
+
+		The modules are still added in the order the serial loader adds them,
+		so the result is the same.  Pass 0 threads to load serially again.
+		"""
+		self.parallel = (threads, processes, process_threshold) if threads else None
+
+	def invalidate_listings(self, directory = None):
+		""" Forget the directory listings load paths are resolved with, for
+		``directory`` or all directories.  Call this after adding template
+		files to an include directory.
+		"""
+		if directory is None:
+			self.listings.clear()
+		else:
+			self.listings.pop(os.path.normcase(os.path.abspath(directory)), None)
+
+	def _listing(self, directory):
+		key = os.path.normcase(os.path.abspath(directory))
+		listing = self.listings.get(key)
+		if listing is None:
+			try:
+				listing = set(map(os.path.normcase, os.listdir(key)))
+			except OSError:
+				listing = set()
+			self.listings[key] = listing
+			self.resolve_stats["listings"] += 1
+
+		return listing
+
+	def _exists(self, path):
+		directory, name = os.path.split(path)
+		if name in ("", os.curdir, os.pardir):
+			return os.path.exists(path)
+		return os.path.normcase(name) in self._listing(directory or os.curdir)
+
 	# current is the 'current' directory.  first choice to resolve
 	# relative paths
 	def _resolve_path(self, path, current):
-		resolved_path = path
-
-		if not os.path.isabs(path):
-			paths = []
-			if current:
-				paths.append(current)
-			paths.extend(self.paths)
-			
-			for prefix in paths:
-				joined = os.path.join(prefix, path)
-				if os.path.exists(joined):
-					resolved_path = joined
-					break
-	
+		if os.path.isabs(path):
+			return path
+
+		start = time.perf_counter()
+		resolved_path = self._find_path(path, current)
+
+		stats = self.resolve_stats
+		stats["loads"] += 1
+		stats["time"] += time.perf_counter() - start
 		return resolved_path
 
+	def _find_path(self, path, current):
+		# _resolve_path without the stats, for the parallel loader.  the
+		# serial loader resolves the same loads again and counts them.
+		paths = []
+		if current:
+			paths.append(current)
+		paths.extend(self.paths)
+
+		for prefix in paths:
+			joined = os.path.join(prefix, path)
+			if self._exists(joined):
+				return joined
+
+		return path
+
 	def load_text(self, text, name, current = "", parser = Parser()):
 		""" load_text(self, text, name, parser = Parser())
 		Loads a template module defined in a string.
@@ -230,10 +998,102 @@ class Engine:
 		:rtype: the module definition
 		"""
 		path = os.path.abspath(path) #normalize the path
-		tpl = open(path)
-		module = self.load_module(tpl, path, os.path.dirname(path), parser)
-		tpl.close()
-		return module
+		module = self.definitions.get(path, None)
+		if module:
+			self.trace("Modules {} is already loaded".format(path))
+			return module
+
+		if self.parallel and self._prefetched is None:
+			self._prefetched = self._prefetch(path, parser)
+			try:
+				return self.load_file(path, parser)
+			finally:
+				self._prefetched = None
+
+		fetched = None
+		if self._prefetched:
+			fetched = self._prefetched.pop((path, parser.signature()), None)
+		if fetched is None:
+			fetched = self._read_module(path, parser)
+		elif isinstance(fetched, Exception):
+			raise fetched
+
+		stat, module, text = fetched
+		self.sources[path] = (parser, (stat.st_mtime_ns, stat.st_size))
+
+		if text is not None and self.cache:
+			# store before the loads are resolved, include paths may change
+			module.path = path
+			self._compile_module(module)
+			self.cache.store(path, parser, module, text, stat)
+
+		return self._add_module(module, path, os.path.dirname(path), parser)
+
+	def _read_module(self, path, parser, process_pool = None, process_threshold = 0):
+		# returns the stat result, the module definition and the text it was
+		# parsed from, or None for the text if the cache had the module
+		stat = os.stat(path)
+
+		if self.cache:
+			module = self.cache.load(path, parser)
+			if module:
+				self.trace("Loaded module {} from cache".format(path))
+				return stat, module, None
+
+		with open(path) as tpl:
+			text = tpl.read()
+
+		self.trace("Loading module {}".format(path))
+		if process_pool and len(text) > process_threshold:
+			module = process_pool.submit(_parse_file, parser, path, text).result()
+		else:
+			module = parser.process_module(base.StringIO(text), path)
+
+		return stat, module, text
+
+	def _prefetch(self, path, parser):
+		# reads and parses the module at path and the modules it loads, level
+		# by level.  errors are kept as results, so they surface at the point
+		# the serial loader would run into them.
+		threads, processes, process_threshold = self.parallel
+		results = {}
+		process_pool = None
+		if processes:
+			process_pool = concurrent.futures.ProcessPoolExecutor(processes)
+
+		try:
+			with concurrent.futures.ThreadPoolExecutor(threads) as thread_pool:
+				level = [(path, parser)]
+				while level:
+					futures = []
+					for path, parser in level:
+						key = (path, parser.signature())
+						if key in results or path in self.definitions:
+							continue
+						results[key] = None
+						future = thread_pool.submit(self._read_module,
+							path, parser, process_pool, process_threshold)
+						futures.append((key, path, parser, future))
+
+					level = []
+					for key, path, parser, future in futures:
+						try:
+							results[key] = fetched = future.result()
+						except Exception as e:
+							results[key] = e
+							continue
+
+						current = os.path.dirname(path)
+						loads = fetched[1].template_loads
+						for load in [] if self.lazy else loads:
+							load_path = self._find_path(load.path, "" if load.abs else current)
+							load_parser = parser.derive(load.directive_token, load.placeholder)
+							level.append((os.path.abspath(load_path), load_parser))
+		finally:
+			if process_pool:
+				process_pool.shutdown()
+
+		return results
 
 	def load_module(self, input_stream, path, current, parser):
 		""" load_module(self, text, name, parser = Parser())
@@ -246,16 +1106,22 @@ class Engine:
 
 		:rtype: the module definition
 		"""
-		module = self.modules.get(path, None)
+		module = self.definitions.get(path, None)
 		if module:
-			self.trace("Modules {} is already loaded", path)
+			self.trace("Modules {} is already loaded".format(path))
 			return module
 
 		self.trace("Loading module {}".format(path))
 
 		module = parser.process_module(input_stream, path)
+		return self._add_module(module, path, current, parser)
+
+	def _add_module(self, module, path, current, parser):
 		module.path = path
-		self.modules[path] = module
+		self.definitions[path] = module
+		self.pending.add(path)
+		if path not in self.runtime_modules:
+			self.modules[path] = module
 
 		fixed_loads = []
 
@@ -265,69 +1131,335 @@ class Engine:
 			if load.abs:
 				load_current = ""
 
-			load_parser = Parser(load.directive_token, load.placeholder)
+			load_parser = parser.derive(load.directive_token, load.placeholder)
 			path = self._resolve_path(load.path, load_current)
-			imported = self.load_file(path, load_parser)
+			if self.lazy:
+				path = os.path.abspath(path)
+				if path not in self.definitions:
+					self.deferred.setdefault(path, load_parser)
+			else:
+				path = self.load_file(path, load_parser).path
 
 			#update with canonical path
 			fixed = copy.copy(load)
-			fixed.path = imported.path
+			fixed.path = path
+			self.dependents.setdefault(path, set()).add(module.path)
 
 			fixed_loads.append(fixed)
 
 		module.template_loads = fixed_loads
 		return module
 
+	def _compile_module(self, mod_definition):
+		_compile_definition(mod_definition)
+
 	def make(self):
 		""" Compile all loaded modules.
 
 		After the function is called, the entire ``modules`` dictionary is
-		replaced with callable modules.
+		replaced with callable modules.  Modules that were made before are
+		only compiled again if they were reloaded, and keep their identity.
 		"""
-		runtime_modules = {}
+		self._make(list(self.definitions))
+
+	def _make(self, paths):
+		# makes the pending modules among paths and the modules they load.
+		# loaded modules first, so attributes can refer to their attributes
+		pending = []
+		visited = set()
+		def visit(path):
+			if path in visited or path not in self.definitions:
+				return
+			visited.add(path)
+			for load in self.definitions[path].template_loads:
+				visit(load.path)
+			if path in self.pending:
+				pending.append(path)
+
+		for path in paths:
+			visit(path)
+
+		if not self.lazy:
+			for path in pending:
+				self._compile_module(self.definitions[path])
 
 		# create runtime modules
-		for key, mod_definition in self.modules.items():
-			module = Template_Module()
-			runtime_modules[key] = module
-
-		for key, mod_definition in self.modules.items():
-			module = runtime_modules[key]
-			#auto-import texthon utilities
-			setattr(module, "_utils", utils)
-
-			for alias, py_module in mod_definition.py_imports.items():
-				setattr(module, alias, importlib.import_module(py_module))
-
-			for load in mod_definition.template_loads:
-				ref = runtime_modules[load.path]
-				setattr(module, load.alias, ref)
-
-			for name, exp in mod_definition.variables.items():
-				exp_eval = eval(exp, module.__dict__, {})
-				setattr(module, name, exp_eval)
-
-			for name, func_definition in mod_definition.templates.items():
-				func = Template_Function()
-				func.name = name
-				func.text = func_definition.text
-				func.varargs = func_definition.varargs
-				func.params = func_definition.params
-				func.module = module
-				func.definition_line = func_definition.definition_line
-				func.path = mod_definition.path
-				func.source_lines = func_definition.source_lines
-
-				# compile with error translation
-				try:
-					func.code = compile(func_definition.code, func.path, "exec")
-				except SyntaxError as e:
-					e.lineno = func.source_lines[e.lineno - 1]
-					raise e
+		for path in pending:
+			module = self.runtime_modules.get(path)
+			if module is None:
+				self.runtime_modules[path] = Template_Module()
+			else:
+				module._reset()
+
+		# stand-ins for the modules loading was deferred for
+		for path in pending if self.lazy else []:
+			for load in self.definitions[path].template_loads:
+				if load.path not in self.runtime_modules:
+					self.runtime_modules[load.path] = self._deferred_module(load.path)
+
+		for path in pending:
+			self._make_module(self.runtime_modules[path], self.definitions[path])
+
+		self.pending.difference_update(pending)
+		self.modules = dict(self.runtime_modules)
+
+		stats = self.resolve_stats
+		self.trace("Resolved {} load paths with {} directory listings in {:.3f} ms".format(
+			stats["loads"], stats["listings"], stats["time"] * 1e3))
+
+	def _deferred_module(self, path):
+		module = Template_Module()
+		module.__dict__["_loader"] = lambda: self._load_deferred(path)
+		return module
+
+	def _load_deferred(self, path):
+		with self.lock:
+			if path not in self.definitions:
+				self.trace("Loading deferred module {}".format(path))
+				self.load_file(path, self.deferred[path])
+			self.deferred.pop(path, None)
+			self.make()
+
+	def render(self, path, params = {}, name = "main"):
+		""" Renders the template function ``name`` of the made module at
+		``path`` with the keyword arguments ``params``, in a new
+		``Render_Context``.  Renders may run concurrently on any number of
+		threads, as long as the engine isn't loading, making or refreshing
+		modules meanwhile.  In lazy mode, the first renders to use a
+		deferred module wait for it to be made.
+
+		:rtype: the output string
+		"""
+		if path not in self.modules:
+			path = os.path.abspath(path)
+		module = Render_Context(self.modules, self.lock if self.lazy else None).module(path)
+		return getattr(module, name)(**params)
+
+	def _make_module(self, module, mod_definition):
+		#auto-import texthon utilities
+		setattr(module, "_utils", utils)
+
+		for alias, py_module in mod_definition.py_imports.items():
+			setattr(module, alias, importlib.import_module(py_module))
+
+		for load in mod_definition.template_loads:
+			ref = self.runtime_modules[load.path]
+			setattr(module, load.alias, ref)
+
+		for name, exp in mod_definition.variables.items():
+			exp_eval = eval(exp, module.__dict__, {})
+			setattr(module, name, exp_eval)
+
+		for name, func_definition in mod_definition.templates.items():
+			func = Template_Function()
+			func.name = name
+			func.text = func_definition.text
+			func.varargs = func_definition.varargs
+			func.params = func_definition.params
+			func.module = module
+			func.definition_line = func_definition.definition_line
+			func.path = mod_definition.path
+			func.source_lines = func_definition.source_lines
+			func.cache_size = func_definition.cache_size
+			func.is_async = func_definition.is_async
+			func.stats = self.memo_stats
+			func.profiler = self.profiler
+			func.code = func_definition.compiled
+			if func.code is None:
+				# lazy mode, compiled on the first call
+				func.definition = func_definition
+			else:
+				func.dependencies = sorted(
+					_code_names(func.code).intersection(mod_definition.templates))
+			module._templates[name] = func
 
-				setattr(module, name, func)
+	def render_many(self, template, param_sets, processes = 0, parser = Parser()):
+		""" Renders the ``main`` function of a template once for every
+		parameter set.  See ``render_jobs``.
 
+		:param template: path of the template module
+		:param param_sets: list of keyword argument dictionaries
+		"""
+		return self.render_jobs([(template, params) for params in param_sets],
+			processes, parser)
+
+	def render_jobs(self, jobs, processes = 0, parser = Parser()):
+		""" Renders a batch of ``(template, params)`` jobs, calling the ``main``
+		function of each template with the params as keyword arguments.
+
+		Every template is loaded (unless it already is) and made once.  With
+		``processes``, the jobs are spread over a pool of worker processes
+		forked from this one, so the workers start with the made modules.  On
+		platforms that can't fork, the jobs render in this process.
+
+		Each job renders in its own ``Render_Context``, so changes a job makes
+		to module attributes aren't seen by the others.  A failing job doesn't
+		stop the others.  A template that fails to load or make (a syntax
+		error, a failing attribute expression) fails its jobs, and leaves the
+		engine as it was before loading it.
+
+		:rtype: list of ``(output, error)`` in job order, where either the
+			output or the error message is None
+		"""
+		jobs = list(jobs)
+		paths = {}
+		for template, params in jobs:
+			if template in paths:
+				continue
+
+			# each template is loaded and made on its own, so its errors
+			# are the errors of its jobs
+			state = self._save_state()
+			try:
+				if template in self.definitions:
+					path = template
+				else:
+					path = self.load_file(template, parser).path
+				self._make([path])
+				paths[template] = path
+			except Exception as e:
+				# leave nothing partly loaded or made
+				self._restore_state(state)
+				paths[template] = e
+
+		jobs = [(paths[template], "main", params) for template, params in jobs]
+		if not processes or "fork" not in multiprocessing.get_all_start_methods():
+			return [self._render_job(*job) for job in jobs]
+
+		global _render_engine
+		_render_engine = self
+		try:
+			with multiprocessing.get_context("fork").Pool(processes) as pool:
+				return pool.map(_render_job, jobs)
+		finally:
+			_render_engine = None
 
-		self.modules = runtime_modules
+	def _render_job(self, path, name, params):
+		if isinstance(path, Exception):
+			return None, str(path)
 
+		try:
+			return self.render(path, params, name), None
+		except Exception as e:
+			return None, str(e)
+
+	def _source_changed(self, path):
+		parser, signature = self.sources[path]
+		try:
+			stat = os.stat(path)
+		except OSError:
+			# keep what we have if the file went away
+			return False
+
+		return (stat.st_mtime_ns, stat.st_size) != signature
+
+	def _save_state(self):
+		# the loading state of the engine, for _restore_state to roll a
+		# failed load or make of new modules back to
+		return (dict(self.definitions), dict(self.sources),
+			{path : set(paths) for path, paths in self.dependents.items()},
+			set(self.pending), dict(self.modules), dict(self.deferred),
+			dict(self.runtime_modules))
+
+	def _restore_state(self, state):
+		(self.definitions, self.sources, self.dependents, self.pending,
+			self.modules, self.deferred, self.runtime_modules) = state
+
+	def _reload(self, path):
+		old = self.definitions.pop(path)
+		for load in old.template_loads:
+			self.dependents.get(load.path, set()).discard(path)
+
+		self.load_file(path, self.sources[path][0])
+
+	def refresh(self):
+		""" Reloads the template files that changed since they were loaded.
+
+		Only the changed files are parsed again.  If modules were made, the
+		changed modules and the modules that load them (directly or not) are
+		compiled again in place, so references to them stay valid.
+
+		Nothing is remade unless every changed file parses and compiles.
+		Otherwise the error is raised and the engine is left as it was, so
+		the next refresh sees the same files as changed.
+
+		:rtype: sorted list of the paths of the affected modules
+		"""
+		changed = [path for path in list(self.sources) if self._source_changed(path)]
+		if changed:
+			# the changed modules may load files added since
+			self.invalidate_listings()
+
+		state = self._save_state()
+		try:
+			for path in changed:
+				self.trace("Reloading module {}".format(path))
+				self._reload(path)
+			if not self.lazy:
+				for path in self.pending:
+					self._compile_module(self.definitions[path])
+		except Exception:
+			self._restore_state(state)
+			raise
+
+		# the dependents closure of the changed modules
+		affected = set()
+		visit = list(changed)
+		while visit:
+			path = visit.pop()
+			if path in affected:
+				continue
+			affected.add(path)
+			visit.extend(self.dependents.get(path, ()))
+
+		self.pending.update(affected)
+		if self.runtime_modules:
+			self.make()
+
+		return sorted(affected)
+
+	def closure(self, path):
+		""" Returns the paths of the module at ``path`` and of the modules it
+		loads, directly or not, with loaded modules before the modules that
+		load them.  Modules deferred by lazy mode are loaded.
+		"""
+		order = []
+		visited = set()
+
+		def visit(path):
+			if path in visited:
+				return
+			visited.add(path)
+
+			definition = self.definitions.get(path)
+			if definition is None:
+				definition = self.load_file(path, self.deferred[path])
+			for load in definition.template_loads:
+				visit(load.path)
+			order.append(path)
+
+		visit(path)
+		return order
+
+	def dependencies(self, path):
+		""" Returns the files the output of the module at ``path`` depends
+		on: the template files in its ``closure`` and the source files of the
+		Python modules they import.  Built-in modules have no file and are
+		left out.
+
+		:rtype: sorted list of paths
+		"""
+		files = set()
+		for module_path in self.closure(path):
+			if module_path in self.sources:
+				files.add(module_path)
+
+			for py_module in self.definitions[module_path].py_imports.values():
+				try:
+					spec = importlib.util.find_spec(py_module)
+				except (ImportError, ValueError):
+					continue
+				if spec is not None and spec.has_location and spec.origin:
+					files.add(spec.origin)
 
+		return sorted(files)
@@ -0,0 +1,154 @@
+# Copyright 2013 Kevin Lin
+# Licensed under the Apache License, Version 2.0
+
+""" Ahead of time export of template modules to a standalone Python module.
+
+The exported module needs neither the template files nor texthon.  It holds
+the code of the template functions, their text, the imports and attributes
+of the template modules, and a copy of the runtime classes of
+``texthon.engine`` and the utilities of ``texthon.utils``.
+"""
+
+from . import engine
+from . import utils
+import inspect
+
+# engine classes and functions the exported module needs at runtime
+runtime = [
+	engine.Exec_Exception,
+	engine.Output,
+	engine.Output_Set,
+	engine.Template_Function,
+	engine._merge,
+	engine._code_names,
+	engine._linearize,
+	engine.Template_Module,
+]
+
+header = """# Generated by texthon from {}
+# Do not edit, export the template again instead.
+
+import asyncio
+import collections
+import contextlib
+import importlib
+import io
+import linecache
+import sys
+import traceback
+import types
+import weakref
+
+base = types.SimpleNamespace(StringIO = io.StringIO)
+memo_stats = {{"hits" : 0, "misses" : 0, "uncacheable" : 0}}
+
+def _template_code(function, name, path):
+	# template code looks like it was compiled from the template file, so
+	# tracebacks are translated to template lines
+	def retarget(code):
+		consts = tuple(retarget(const) if isinstance(const, types.CodeType) else const
+			for const in code.co_consts)
+		return code.replace(co_filename = path, co_consts = consts)
+
+	code = retarget(function.__code__).replace(co_name = name)
+	if hasattr(code, "co_qualname"):
+		code = code.replace(co_qualname = name)
+	return code
+"""
+
+def _runtime_source():
+	sources = [inspect.getsource(item) for item in runtime]
+	sources.append("_wrapper_codes = (Template_Function._compile_call.__code__,\n"
+		"\tTemplate_Function._memo_call.__code__, Template_Function._profile_call.__code__)\n")
+	return "\n".join(sources)
+
+def _utils_source():
+	source = inspect.getsource(utils)
+	source = source[source.index("from . import base"):].replace("from . import base\n", "", 1)
+	names = [name for name, value in vars(utils).items()
+		if not name.startswith("_") and getattr(value, "__module__", None) == utils.__name__]
+	arguments = ", ".join("{0} = {0}".format(name) for name in names)
+	# Output refers to the utilities as utils
+	return source + "\n_utils = utils = types.SimpleNamespace({})\n".format(arguments)
+
+def export(template_engine, path, out):
+	""" Writes the template module at ``path``, which has to be loaded in
+	``template_engine``, and the modules it loads to the stream ``out`` as a
+	Python module.
+
+	The exported module has ``modules`` (path to module), the exported
+	``module`` and a ``main`` function calling ``module.main``.
+	"""
+	paths = template_engine.closure(path)
+	definitions = [template_engine.definitions[module_path] for module_path in paths]
+	for definition in definitions:
+		template_engine._compile_module(definition)
+
+	lines = []
+	def write(text):
+		lines.extend(text.split("\n"))
+
+	write(header.format(path))
+	write(_runtime_source())
+	write(_utils_source())
+
+	# (module index, name) -> line of the function in the exported module
+	def_lines = {}
+	for index, definition in enumerate(definitions):
+		write("# {}".format(definition.path))
+		for name, func_definition in definition.templates.items():
+			def_lines[index, name] = len(lines) + 1
+			code = func_definition.code.replace("def {}(".format(name),
+				"def _t{}_{}(".format(index, name), 1)
+			write(code)
+
+		for name, exp in definition.variables.items():
+			write("def _a{}_{}():\n\treturn (\n{}\n\t)\n".format(index, name, exp.rstrip("\n")))
+
+	write("def _make():")
+	write("\tmodules = {}")
+	for module_path in paths:
+		write("\tmodules[{!r}] = Template_Module()".format(module_path))
+
+	for index, definition in enumerate(definitions):
+		write("")
+		write("\tmodule = modules[{!r}]".format(definition.path))
+		write("\tsetattr(module, '_utils', _utils)")
+		for alias, py_module in definition.py_imports.items():
+			write("\tsetattr(module, {!r}, importlib.import_module({!r}))".format(alias, py_module))
+		for load in definition.template_loads:
+			write("\tsetattr(module, {!r}, modules[{!r}])".format(load.alias, load.path))
+		for name in definition.variables:
+			write("\tsetattr(module, {!r}, types.FunctionType(_a{}_{}.__code__, module.__dict__)())".format(
+				name, index, name))
+
+		for name, func_definition in definition.templates.items():
+			code = func_definition.compiled
+			dependencies = sorted(engine._code_names(code).intersection(definition.templates))
+			padding = def_lines[index, name] - 1
+			write("\tfunc = Template_Function()")
+			write("\tfunc.name = {!r}".format(name))
+			write("\tfunc.text = {!r}".format(func_definition.text))
+			write("\tfunc.varargs = {!r}".format(func_definition.varargs))
+			write("\tfunc.params = {!r}".format(func_definition.params))
+			write("\tfunc.module = module")
+			write("\tfunc.definition_line = {!r}".format(func_definition.definition_line))
+			write("\tfunc.path = {!r}".format(definition.path))
+			write("\tfunc.source_lines = [0] * {} + {!r}".format(padding,
+				list(func_definition.source_lines)))
+			write("\tfunc.cache_size = {!r}".format(func_definition.cache_size))
+			write("\tfunc.is_async = {!r}".format(func_definition.is_async))
+			write("\tfunc.stats = memo_stats")
+			write("\tfunc.code = _template_code(_t{}_{}, {!r}, {!r})".format(
+				index, name, name, definition.path))
+			write("\tfunc.dependencies = {!r}".format(dependencies))
+			write("\tmodule._templates[{!r}] = func".format(name))
+
+	write("\treturn modules")
+	write("")
+	write("modules = _make()")
+	write("module = modules[{!r}]".format(path))
+	write("")
+	write("def main(*args, **kwargs):")
+	write("\treturn module.main(*args, **kwargs)")
+	out.write("\n".join(lines) + "\n")
@@ -0,0 +1,221 @@
+# Copyright 2013 Kevin Lin
+# Licensed under the Apache License, Version 2.0
+
+""" Writing rendered output to files without touching files whose content
+didn't change, so build tools don't see them as modified, and telling build
+tools which files an output depends on.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import locale
+import os
+
+# bytes compared at a time with the existing file
+chunk_size = 64 * 1024
+
+def encode(text, encoding = None):
+	""" Returns ``text`` as the bytes a file opened for writing in text mode
+	would get, with ``encoding`` or the preferred encoding.
+	"""
+	if os.linesep != "\n":
+		text = text.replace("\n", os.linesep)
+	return text.encode(encoding or locale.getpreferredencoding(False))
+
+def same_content(path, data):
+	""" Returns whether the file at ``path`` holds exactly the bytes ``data``.
+	Files of a different size are never read.
+	"""
+	try:
+		if os.stat(path).st_size != len(data):
+			return False
+
+		view = memoryview(data)
+		position = 0
+		with open(path, "rb") as f:
+			while True:
+				chunk = f.read(chunk_size)
+				if not chunk:
+					return position == len(data)
+				if view[position:position + len(chunk)] != chunk:
+					return False
+				position += len(chunk)
+	except FileNotFoundError:
+		return False
+
+def write_atomic(path, data):
+	""" Writes the bytes ``data`` to a temporary file next to ``path`` and
+	renames it to ``path``, so readers see either the old or the new content.
+	The permissions of an existing file are kept.
+	"""
+	directory = os.path.dirname(os.path.abspath(path))
+	while True:
+		temp_path = os.path.join(directory, ".{}.{}.tmp".format(
+			os.path.basename(path), os.urandom(4).hex()))
+		try:
+			# created with the permissions a plain open would give
+			fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+			break
+		except FileExistsError:
+			continue
+
+	try:
+		with os.fdopen(fd, "wb") as f:
+			f.write(data)
+		try:
+			os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+		except FileNotFoundError:
+			pass
+		os.replace(temp_path, path)
+	except BaseException:
+		os.remove(temp_path)
+		raise
+
+def write_if_changed(path, text, encoding = None):
+	""" Writes ``text`` to the file at ``path`` with ``write_atomic``, unless
+	the file already has that content.
+
+	:rtype: whether the file was written
+	"""
+	data = encode(text, encoding)
+	if same_content(path, data):
+		return False
+
+	write_atomic(path, data)
+	return True
+
+class Output_Writer:
+	""" Writes output files with ``write_if_changed`` on background threads,
+	so comparing and writing files overlap with each other and with the
+	caller's work between ``write`` and ``close``.  Call ``close`` to wait for
+	the writes and raise their errors.
+
+	:param threads: the number of writer threads
+	"""
+
+	def __init__(self, threads = 4):
+		self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+		self.futures = []
+		self.written = 0
+		self.changed = 0
+
+	def write(self, path, text):
+		""" Queues writing ``text`` to the file at ``path``, creating the
+		directories it needs
+		"""
+		self.futures.append(self.executor.submit(self._write, path, text))
+
+	def _write(self, path, text):
+		directory = os.path.dirname(path)
+		if directory:
+			os.makedirs(directory, exist_ok = True)
+		return write_if_changed(path, text)
+
+	def close(self):
+		""" Waits for the queued writes """
+		futures = self.futures
+		self.futures = []
+		try:
+			for future in futures:
+				changed = future.result()
+				self.written += 1
+				self.changed += changed
+		finally:
+			self.executor.shutdown()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+
+def _escape_make(path):
+	return path.replace("\\", "\\\\").replace(" ", "\\ ").replace("#", "\\#").replace("$", "$$")
+
+def write_depfile(out, targets, dependencies):
+	""" Writes a depfile in the Makefile syntax gcc uses for ``-MD``, which
+	ninja reads as well, stating that ``targets`` depend on the files
+	``dependencies``.
+	"""
+	out.write(" ".join(_escape_make(target) for target in targets) + ":")
+	for dependency in dependencies:
+		out.write(" \\\n  " + _escape_make(dependency))
+	out.write("\n")
+
+def hash_file(path):
+	h = hashlib.sha1()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(chunk_size), b""):
+			h.update(chunk)
+	return h.hexdigest()
+
+class Input_Manifest:
+	""" Records the input files of a render and their content hashes, to
+	skip the render when it would produce the same output.
+
+	Inputs are compared by modification time and size first, and by content
+	hash if those changed, like the module cache does.
+
+	:param path: the json file the manifest is kept in
+	:param key: json compatible settings of the render, such as the template,
+		the parameters and the output path.  A manifest recorded with a
+		different key is out of date.
+	"""
+
+	def __init__(self, path, key):
+		self.path = path
+		self.key = key
+
+	def _read(self):
+		try:
+			with open(self.path) as f:
+				return json.load(f)
+		except (OSError, ValueError):
+			return None
+
+	def recorded(self):
+		""" Returns the recorded input paths and outputs, or None if there's
+		no manifest for the key
+		"""
+		manifest = self._read()
+		if manifest is None or manifest.get("key") != self.key:
+			return None
+		return sorted(manifest["inputs"]), manifest.get("outputs", [])
+
+	def up_to_date(self, outputs = ()):
+		""" Returns whether the recorded inputs are unchanged and the files
+		``outputs`` and the recorded outputs exist
+		"""
+		manifest = self._read()
+		if manifest is None or manifest.get("key") != self.key:
+			return False
+		outputs = list(outputs) + manifest.get("outputs", [])
+		if not all(os.path.exists(output) for output in outputs):
+			return False
+
+		for path, (mtime, size, digest) in manifest["inputs"].items():
+			try:
+				stat = os.stat(path)
+			except OSError:
+				return False
+			if stat.st_mtime_ns == mtime and stat.st_size == size:
+				continue
+			if hash_file(path) != digest:
+				return False
+
+		return True
+
+	def record(self, inputs, outputs = ()):
+		""" Stores the current state of the files ``inputs``, and the
+		``outputs`` to expect next time
+		"""
+		entries = {}
+		for path in inputs:
+			# stat first, a change while hashing is seen next time
+			stat = os.stat(path)
+			entries[path] = (stat.st_mtime_ns, stat.st_size, hash_file(path))
+
+		manifest = {"key" : self.key, "inputs" : entries, "outputs" : list(outputs)}
+		text = json.dumps(manifest, indent = 1, sort_keys = True)
+		write_atomic(self.path, encode(text + "\n", "utf-8"))
@@ -2,17 +2,44 @@
 # Licensed under the Apache License, Version 2.0
 
 from . import base
+import array
+import ast
+import re
 import shlex
 import io
+import marshal
 
 class Template_Definition:
+	__slots__ = ("text", "code", "definition_line", "source_lines", "varargs", "params",
+		"cache_size", "is_async", "compiled")
+
 	def __init__(self):
 		self.text = []
 		self.code = ""
 		self.definition_line = 0
-		self.source_lines = []
-		self.varags = False
+		# template line of each line of code
+		self.source_lines = array.array("I")
+		self.varargs = False
 		self.params = []
+		# number of outputs to memoize, 0 if the template isn't memoized
+		self.cache_size = 0
+		# whether the code awaits, making it a coroutine function
+		self.is_async = False
+		# code object, filled in by the engine
+		self.compiled = None
+
+	def __getstate__(self):
+		# code objects can't be pickled, but they can be marshalled
+		state = {name : getattr(self, name) for name in self.__slots__}
+		if self.compiled is not None:
+			state["compiled"] = marshal.dumps(self.compiled)
+		return state
+
+	def __setstate__(self, state):
+		if state.get("compiled") is not None:
+			state["compiled"] = marshal.loads(state["compiled"])
+		for name, value in state.items():
+			setattr(self, name, value)
 
 	def dump(self):
 		print("code: ")
@@ -21,6 +48,8 @@ class Template_Definition:
 		print(self.text)
 
 class Template_Load:
+	__slots__ = ("alias", "path", "abs", "directive_token", "placeholder")
+
 	def __init__(self):
 		self.alias = ""
 		self.path = ""
@@ -31,6 +60,8 @@ class Template_Load:
 class Module_Definition:
 	""" A parsed template module. """
 
+	__slots__ = ("path", "py_imports", "template_loads", "templates", "variables")
+
 	def __init__(self):
 		self.path = None
 		self.py_imports = {}
@@ -76,13 +107,28 @@ class Parse_Context:
 		self.textIndex = 0
 		self.stack = list()
 		self.require_pass = False
+		# whether the write method is bound again when each open exec block
+		# closes
+		self.rebinds = []
+		# code of the current template, joined at the end of the definition
+		self.code = []
+		# output writes not emitted yet: (text, expression, line) tuples
+		self.writes = []
 
 class Parser:
 	""" The parser used to process template files.
 
 	:param directive_token: the prefix that indicates the start of a directive line.
 	:param sub_ch: the character that indicates the start of a placeholder
+
+	Set the ``optimize`` attribute to False to generate one write per text
+	fragment instead of fusing adjacent literals and placeholders.
 	"""
+
+	optimize = True
+	# memoized outputs of templates declared with a bare cache option
+	default_cache_size = 128
+
 	def __init__(self,
 			directive_token = "#",
 			sub_ch = "$",
@@ -100,6 +146,24 @@ class Parser:
 
 		self.verbose = False
 
+	def __reduce__(self):
+		# the keyword table holds bound methods, so pickle the settings only
+		return (_restore_parser, self.signature())
+
+	def signature(self):
+		""" Returns a tuple of the parser kind and the settings that affect
+		the parsed module definitions.
+		"""
+		return (type(self), self.directive_token, self.placeholder, self.optimize)
+
+	def derive(self, directive_token, placeholder):
+		""" Returns a parser of the same kind with different settings.  Used
+		to process the files referred to by load directives.
+		"""
+		parser = type(self)(directive_token, placeholder)
+		parser.optimize = self.optimize
+		return parser
+
 	def _print(self, context, text):
 		print("{0}({1}): {2}".format(context.title, context.line, text))
 
@@ -122,6 +186,9 @@ class Parser:
 			self.warning(context, "missing end directive for {0}".format(
 				scope_types.names[scope.scope]))
 
+			if context.template:
+				self.end_template(context)
+
 		return module
 
 	def parse_line(self, context, line):
@@ -253,19 +320,33 @@ class Parser:
 			arguments = line[cursor:].strip()
 			self.trace(context, "exec directive,{0} {1}".format(symbol, arguments))
 
+			# statements using _output, such as indenting it, may change its
+			# write method, which the fused writes hold on to
+			rebind = self.optimize and "_output" in arguments
 			if symbol == "!":
 				self.emit_code(context, arguments)
+				if rebind:
+					self.emit_code(context, "_write = _output.write")
 			elif symbol == '{':
 				self.emit_code(context, arguments)
 				context.indent += 1
 				context.require_pass = True
+				# a with block may restore the write method when it ends, rebinding
+				# after other blocks would split if from else
+				rebind = rebind and arguments.startswith("with")
+				context.rebinds.append(rebind)
+				if rebind:
+					self.emit_code(context, "_write = _output.write")
 			elif symbol == '}':
-				if context.indent <= 0:
+				if context.indent <= 1:
 					raise Parse_Exception(context, "mismatched end bracket")
+				self.flush_writes(context)
 				if context.require_pass:
 					self.emit_code(context, "pass")
 				context.indent -= 1
 				self.emit_code(context, arguments)
+				if context.rebinds.pop() or rebind:
+					self.emit_code(context, "_write = _output.write")
 			else:
 				raise Parse_Exception(context, "unknown execution symbol {}".format(symbol))
 		else:
@@ -326,6 +407,28 @@ class Parser:
 		self.trace(context, "import directive: {0} as {1}".format(module, alias))
 		context.module.py_imports[alias] = module
 
+	def parse_options(self, options_text, option_map):
+		# split by comma, preserve quotes
+		comma_lex = shlex.shlex(options_text)
+		comma_lex.whitespace_split = True
+		comma_lex.whitespace = ","
+		comma_lex.commenters = ""
+
+		for option in comma_lex:
+			# split by eq, strip quotes
+			eq_lex = shlex.shlex(option, posix = True)
+			eq_lex.whitespace_split = True
+			eq_lex.whitespace += "="
+			eq_lex.commenters = ""
+			pair = list(eq_lex)
+			key = pair[0].strip()
+			value = True
+
+			if len(pair) > 1:
+				value = pair[1].strip()
+
+			option_map[key] = value
+
 	def parse_load(self, context, line, cursor):
 		if context.template:
 			self.warning(context, "load directives are not expected inside template definitions")
@@ -350,26 +453,7 @@ class Parser:
 		}
 
 		if params_text:
-			# split by comma, preserve quotes
-			comma_lex = shlex.shlex(params_text)
-			comma_lex.whitespace_split = True
-			comma_lex.whitespace = ","
-			comma_lex.commenters = ""
-
-			for param in comma_lex:
-				# split by eq, strip quotes
-				eq_lex = shlex.shlex(param, posix = True)
-				eq_lex.whitespace_split = True
-				eq_lex.whitespace += "="
-				eq_lex.commenters = ""
-				pair = list(eq_lex)
-				key = pair[0].strip()
-				value = True
-
-				if len(pair) > 1:
-					value = pair[1].strip()
-
-				param_map[key] = value
+			self.parse_options(params_text, param_map)
 
 		load = Template_Load()
 		load.alias = alias
@@ -405,7 +489,25 @@ class Parser:
 
 		cursor, _ = self.parse_space(context, line, cursor)
 		params = []
-		cusor, params_text = self.parse_paren(context, "", line, cursor)
+		cursor, params_text = self.parse_paren(context, "", line, cursor)
+
+		cursor, _ = self.parse_space(context, line, cursor)
+		option_map = {"cache" : False}
+		cursor, options_text = self.parse_paren(context, "", line, cursor)
+		if options_text:
+			self.parse_options(options_text, option_map)
+
+		cache_size = option_map.pop("cache")
+		if option_map:
+			raise Parse_Exception(context, "unknown template options {}".format(", ".join(option_map)))
+		if cache_size is False:
+			cache_size = 0
+		elif cache_size is True:
+			cache_size = self.default_cache_size
+		elif cache_size.isdigit():
+			cache_size = int(cache_size)
+		else:
+			raise Parse_Exception(context, "invalid cache size {}".format(cache_size))
 
 		varargs = False
 
@@ -426,15 +528,19 @@ class Parser:
 		context.stack.append(Parse_Scope(scope_types.template))
 		context.indent = 0
 		context.textIndex = 0
+		context.rebinds = []
 
 		self.trace(context, "template directive: {0}".format(template_name))
 		context.template = Template_Definition()
 		context.template.varargs = varargs
 		context.template.params = params
+		context.template.cache_size = cache_size
 		# store debug information, assume we don't have code that spans lines
 		context.template.definition_line = context.line
 		context.module.templates[template_name] = context.template
 
+		self.emit_function(context, template_name)
+
 	def parse_end(self, context, line, cursor):
 		cursor, end_name = self.parse_identifier_req(context, line, cursor)
 
@@ -450,9 +556,12 @@ class Parser:
 			raise Parse_Exception(context, "mismatched end directive, expected:{0}, actual:{1}".format(expected_name, end_name))
 
 		if scope.scope == scope_types.template:
-			if context.indent != 0:
+			if context.indent != 1:
 				raise Parse_Exception(context, "missing end bracket")
-			context.template = None
+			self.flush_writes(context)
+			if context.require_pass:
+				self.emit_code(context, "pass")
+			self.end_template(context)
 
 		context.stack.pop()
 
@@ -524,25 +633,336 @@ class Parser:
 	def emit_comment(self, context, arguments):
 		self.trace(context, "comment directive " + arguments)
 		if context.template:
+			# comments don't count as statements for compound blocks
+			require_pass = context.require_pass
 			self.emit_code(context, "#" + arguments.rstrip())
+			context.require_pass = require_pass
 		else:
 			# emit nothing, ignore the comment
 			pass
 
+	def emit_function(self, context, name):
+		# the template body becomes a real function.  Builtin locals are
+		# keyword only so they don't interfere with the declared parameters,
+		# _textdb is bound as a default by the engine, _module is a module
+		# attribute
+		template = context.template
+		builtins = "_output, _textdb = None"
+		if template.varargs:
+			signature = "*_args, {}, **_kwargs".format(builtins)
+		elif template.params:
+			signature = "{}, *, {}".format(", ".join(template.params), builtins)
+		else:
+			signature = "*, {}".format(builtins)
+
+		self.emit_code(context, "def {}({}):".format(name, signature))
+		context.indent += 1
+		context.require_pass = True
+
+		if self.optimize:
+			self.emit_code(context, "_write = _output.write")
+
+	def _split_call(self, exp):
+		# returns (callee, arguments) if the expression is a plain call such
+		# as lib.func(x), None otherwise
+		if "(" not in exp:
+			return None
+
+		exp = exp.strip()
+		try:
+			call = ast.parse(exp, mode = "eval").body
+		except SyntaxError:
+			return None
+
+		if not isinstance(call, ast.Call):
+			return None
+
+		func = call.func
+		if not isinstance(func, (ast.Name, ast.Attribute)) or func.col_offset != 0:
+			return None
+
+		# a lone generator argument needs the parentheses of the call
+		if (len(call.args) == 1 and not call.keywords and
+			isinstance(call.args[0], ast.GeneratorExp)):
+			return None
+
+		# ast offsets count utf-8 bytes
+		encoded = exp.encode("utf-8")
+		end = func.end_col_offset
+		arguments = encoded[end:].decode("utf-8").strip()
+		if not arguments.startswith("(") or not arguments.endswith(")"):
+			return None
+
+		return encoded[:end].decode("utf-8"), arguments[1:-1].strip()
+
 	def emit_placeholder_exp(self, context, ident):
 		self.trace(context, "detected placeholder ident {0}".format(ident))
-		self.emit_code(context, "_output.write(str({0}))".format(ident))
+
+		# calls write straight into the output so nested templates don't
+		# have to return their text as intermediate strings
+		call = self._split_call(ident)
+		if call:
+			callee, arguments = call
+			if arguments:
+				arguments = ", " + arguments
+			self.emit_code(context, "_output.call({0}{1})".format(callee, arguments))
+		elif self.optimize:
+			context.writes.append((None, ident, context.line))
+		else:
+			self.emit_code(context, "_output.write(str({0}))".format(ident))
 
 	def emit_literal(self, context, text):
+		if self.optimize:
+			context.writes.append((text, None, context.line))
+			return
+
 		context.template.text.append(text)
 		self.emit_code(context, "_output.write(_textdb[" + str(context.textIndex) + "])")
 		context.textIndex += 1 
 
+	def flush_writes(self, context):
+		""" Emits the buffered writes, fusing adjacent literals and the
+		placeholders of a text line into a single formatted write.
+		"""
+		writes = context.writes
+		if not writes:
+			return
+		context.writes = []
+		line = context.line
+
+		# placeholders of different lines are kept apart, so exceptions
+		# still point at the right source line
+		group = []
+		group_line = None
+		for write in writes:
+			if write[1] is not None:
+				if group_line is not None and write[2] != group_line:
+					self._emit_write_group(context, group, group_line)
+					group = []
+				group_line = write[2]
+			group.append(write)
+
+		self._emit_write_group(context, group, group_line)
+		context.line = line
+
+	def _emit_write_group(self, context, group, exp_line):
+		exps = [write[1] for write in group if write[1] is not None]
+		context.line = exp_line if exps else group[0][2]
+
+		if len(group) == 1 and exps:
+			self.emit_code(context, "_write(str({0}))".format(exps[0]))
+			return
+
+		# %s formatting converts with str() like the unfused writes
+		if exps:
+			text = "".join("%s" if write[0] is None else write[0].replace("%", "%%")
+				for write in group)
+			arguments = " % (" + "".join("({}), ".format(exp) for exp in exps) + ")"
+		else:
+			text = "".join(write[0] for write in group)
+			arguments = ""
+
+		context.template.text.append(text)
+		self.emit_code(context, "_write(_textdb[{}]{})".format(context.textIndex, arguments))
+		context.textIndex += 1
+
+	def end_template(self, context):
+		self.flush_writes(context)
+		if any("_outputs" in line for line in context.code):
+			# memoized calls render into a stream of their own, and hits
+			# couldn't write the outputs again
+			if context.template.cache_size:
+				raise Parse_Exception(context, "templates writing named outputs can't be memoized")
+			# named outputs are shared by the streams of a render
+			context.code.insert(1, "\t_outputs = _output.outputs\n")
+			source_lines = context.template.source_lines
+			source_lines.insert(1, source_lines[0])
+
+		code = "".join(context.code)
+		if "await" in code and self._awaits(code):
+			code = "async " + code
+			context.template.is_async = True
+
+		context.template.code = code
+		# the text is only read from here on
+		context.template.text = tuple(context.template.text)
+		context.code = []
+		context.template = None
+
+	def _awaits(self, code):
+		# code with await only compiles as a coroutine function.  anything
+		# else that fails to compile is left for the engine to report
+		try:
+			compile(code, "<template>", "exec")
+			return False
+		except SyntaxError:
+			pass
+
+		try:
+			compile("async " + code, "<template>", "exec")
+			return True
+		except SyntaxError:
+			return False
+
 	def emit_code(self, context, code):
-		context.template.code += "\t" * context.indent
-		context.template.code += code
-		context.template.code += "\n"
+		if context.writes:
+			self.flush_writes(context)
+
+		context.code.append("\t" * context.indent + code + "\n")
 		# store debug information, assume we don't have code that spans lines
 		context.template.source_lines.append(context.line)
 		context.require_pass = False
 
+
+def _restore_parser(kind, directive_token, placeholder, optimize):
+	parser = kind(directive_token, placeholder)
+	parser.optimize = optimize
+	return parser
+
+class Regex_Parser(Parser):
+	""" A parser with the same syntax and output as ``Parser``, which scans
+	lines with compiled regular expressions and slicing instead of one
+	character at a time.  Considerably faster on large template files.
+
+	:param directive_token: the prefix that indicates the start of a directive line.
+	:param sub_ch: the character that indicates the start of a placeholder
+	"""
+	def __init__(self,
+			directive_token = "#",
+			sub_ch = "$",
+			):
+		Parser.__init__(self, directive_token, sub_ch)
+
+		placeholder = "[{}]".format(re.escape(sub_ch))
+		self._placeholder_re = re.compile(placeholder)
+		# placeholders consume the following character, so an escaped
+		# placeholder can't start a slurp
+		self._slurp_re = re.compile(r"(?:[^{0}]|[{0}][^<])*[{0}]<".format(
+			re.escape(sub_ch)), re.DOTALL)
+		self._quote_res = {}
+
+	_space_re = re.compile(r"\s*")
+	_escape_re = re.compile(r"(?:\\.)*", re.DOTALL)
+	_identifier_re = re.compile(r"\w*")
+	_module_name_re = re.compile(r"[\w.]*")
+	_unescape_re = re.compile(r"\\(.)", re.DOTALL)
+
+	def parse_line(self, context, line):
+		if line.startswith(self.directive_token):
+			self.parse_directive(context, line, len(self.directive_token))
+		elif not context.template:
+			# text is ignored outside of template definitions
+			return
+		elif line.startswith("\\"):
+			cursor, prefix = self.parse_escapestart(context, line, 0)
+			self.parse_text_line(context, prefix + line[cursor:])
+		else:
+			self.parse_text_line(context, line)
+
+	def parse_space(self, context, line, cursor):
+		match = self._space_re.match(line, cursor)
+		return match.end(), match.group()
+
+	def parse_escapestart(self, context, line, cursor):
+		match = self._escape_re.match(line, cursor)
+		return match.end(), match.group()[1::2]
+
+	def parse_identifier(self, context, line, cursor):
+		match = self._identifier_re.match(line, cursor)
+		token = match.group()
+		# digit is not allowed in the first character
+		if token and token[0].isdigit():
+			return cursor, ""
+		return match.end(), token
+
+	def parse_module_name(self, context, line, cursor):
+		match = self._module_name_re.match(line, cursor)
+		return match.end(), match.group()
+
+	def parse_close_quote(self, context, quote_ch, escape, line, cursor):
+		if not escape:
+			end = line.find(quote_ch, cursor)
+			if end < 0:
+				raise Parse_Exception(context, "could not find end delimiter {}".format(quote_ch))
+			return end + 1, line[cursor:end]
+
+		key = (quote_ch, escape)
+		quote_re = self._quote_res.get(key)
+		if not quote_re:
+			# an escape character only escapes if something follows it
+			pattern = r"((?:[{1}].|(?![{1}].)[^{0}])*){0}".format(
+				re.escape(quote_ch), re.escape(escape))
+			quote_re = re.compile(pattern, re.DOTALL)
+			self._quote_res[key] = quote_re
+
+		match = quote_re.match(line, cursor)
+		if not match:
+			raise Parse_Exception(context, "could not find end delimiter {}".format(quote_ch))
+
+		token = match.group(1)
+		if escape in token:
+			token = re.sub("[{}](.)".format(re.escape(escape)), r"\1", token, flags = re.DOTALL)
+		return match.end(), token
+
+	def parse_text_line(self, context, line):
+		#ignored while outside of template definition
+		if not context.template:
+			return
+
+		cursor = 0
+		limit = len(line)
+		literal = []
+
+		search = self._placeholder_re.search
+		if not search(line):
+			if line:
+				self.emit_literal(context, line)
+			return
+
+		# line begin slurps
+		if "<" in line:
+			match = self._slurp_re.match(line)
+			if match:
+				cursor = match.end()
+
+		while cursor < limit:
+			match = search(line, cursor)
+			if not match:
+				literal.append(line[cursor:])
+				break
+
+			index = match.start()
+			literal.append(line[cursor:index])
+			cursor = index + 1
+			if cursor == limit:
+				break
+
+			ch = line[cursor]
+			if ch == line[index]:
+				self.trace(context, "detected placeholder escape")
+				literal.append(ch)
+				cursor += 1
+				continue
+			elif ch == ">":
+				self.trace(context, "detected line slurp")
+				break
+
+			text = "".join(literal)
+			if text:
+				self.emit_literal(context, text)
+			literal = []
+
+			exp = None
+			if ch == "{":
+				cursor, exp = self.parse_close_quote(context, "}", "\\", line, cursor + 1)
+
+			if exp:
+				self.emit_placeholder_exp(context, exp)
+			else:
+				cursor, ident = self.parse_identifier(context, line, cursor)
+				if ident:
+					self.emit_placeholder_exp(context, ident)
+
+		text = "".join(literal)
+		if text:
+			self.emit_literal(context, text)
@@ -0,0 +1,108 @@
+# Copyright 2013 Kevin Lin
+# Licensed under the Apache License, Version 2.0
+
+import sys
+import threading
+import time
+import tracemalloc
+
+class Profile_Entry:
+	""" Totals of one template function.  Times are in seconds, sizes in
+	characters written to the output.
+	"""
+
+	def __init__(self):
+		self.calls = 0
+		self.inclusive = 0.0
+		self.exclusive = 0.0
+		self.emitted = 0
+		self.exclusive_emitted = 0
+		# net change of traced memory, including the functions it calls
+		self.allocated = 0
+
+class Profiler:
+	""" Collects per template function statistics while templates render.
+	Pass it to ``engine.set_profiler`` before ``engine.make``.
+
+	Functions are identified by ``(module path, function name)``.  Calls are
+	also recorded by call stack, for ``write_collapsed``.  Renders on
+	different threads keep separate call stacks.
+
+	:param memory: track allocations with ``tracemalloc``, which makes
+		rendering noticeably slower
+	"""
+
+	def __init__(self, memory = True):
+		self.memory = memory
+		self.entries = {}
+		# collapsed call stack -> exclusive time
+		self.stacks = {}
+		# per thread frames: [key, stack name, child time, child emitted] of
+		# the active calls
+		self.local = threading.local()
+		self.lock = threading.Lock()
+
+	def call(self, func, function, args, output, kwargs):
+		key = (func.path, func.name)
+		frames = getattr(self.local, "frames", None)
+		if frames is None:
+			frames = self.local.frames = []
+		parent = frames[-1] if frames else None
+		name = "{}:{}".format(func.path, func.name)
+		if parent:
+			name = parent[1] + ";" + name
+
+		frame = [key, name, 0.0, 0]
+		frames.append(frame)
+
+		if self.memory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+		memory = tracemalloc.get_traced_memory()[0] if self.memory else 0
+		position = output.tell()
+		start = time.perf_counter()
+		try:
+			function(*args, _output = output, **kwargs)
+		finally:
+			elapsed = time.perf_counter() - start
+			emitted = output.tell() - position
+			frames.pop()
+			allocated = tracemalloc.get_traced_memory()[0] - memory if self.memory else 0
+
+			with self.lock:
+				entry = self.entries.get(key)
+				if entry is None:
+					entry = self.entries[key] = Profile_Entry()
+
+				entry.calls += 1
+				# recursive calls are already part of the outer call
+				if not any(active[0] == key for active in frames):
+					entry.inclusive += elapsed
+					entry.emitted += emitted
+					entry.allocated += allocated
+
+				exclusive = elapsed - frame[2]
+				entry.exclusive += exclusive
+				entry.exclusive_emitted += emitted - frame[3]
+				self.stacks[name] = self.stacks.get(name, 0.0) + exclusive
+
+			if parent:
+				parent[2] += elapsed
+				parent[3] += emitted
+
+	def report(self, out = sys.stderr):
+		""" Writes a table of the recorded functions, slowest first """
+		out.write("{:>8} {:>11} {:>11} {:>10} {:>10} {:>11}  {}\n".format(
+			"calls", "incl ms", "excl ms", "emitted", "excl emit", "alloc", "function"))
+
+		entries = sorted(self.entries.items(), key = lambda item : -item[1].inclusive)
+		for (path, name), entry in entries:
+			out.write("{:8d} {:11.3f} {:11.3f} {:10d} {:10d} {:11d}  {}:{}\n".format(
+				entry.calls, entry.inclusive * 1e3, entry.exclusive * 1e3, entry.emitted,
+				entry.exclusive_emitted, entry.allocated, path, name))
+
+	def write_collapsed(self, out):
+		""" Writes the call stacks in the collapsed format of flamegraph
+		tools, one stack per line with its exclusive time in microseconds.
+		"""
+		for name, exclusive in sorted(self.stacks.items()):
+			out.write("{} {}\n".format(name, int(exclusive * 1e6)))
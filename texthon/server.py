@@ -0,0 +1,152 @@
+# Copyright 2013 Kevin Lin
+# Licensed under the Apache License, Version 2.0
+
+""" Render daemon keeping made template modules resident.
+
+The server listens on a Unix domain socket.  Each connection sends one json
+request line and receives one json response line.  A request has the
+``template`` path, the ``params`` for its ``main`` function, and optionally an
+``output`` path to write the result to, ``if_changed`` to leave the output
+file alone if its content is the same, the ``includes`` to resolve loads with
+and ``regex`` to use the regular expression parser.
+
+A response has either the rendered ``output`` (None if it was written to the
+output path) or an ``error`` with the exception ``type``, ``message`` and
+``traceback``, which has the template source lines for errors raised by
+template code and is empty otherwise.  With ``if_changed``, ``changed`` tells
+whether the output file was written.
+"""
+
+from .engine import Engine
+from .parser import Parser, Regex_Parser
+from . import files
+import json
+import os
+import socket
+import socketserver
+
+default_socket = os.environ.get("TEXTHON_SOCKET",
+	os.path.join(os.path.expanduser("~"), ".texthon.sock"))
+
+class Render_Handler(socketserver.StreamRequestHandler):
+	def handle(self):
+		line = self.rfile.readline()
+		try:
+			request = json.loads(line.decode("utf-8"))
+			response = self.server.respond(request)
+		except Exception as e:
+			response = {"error" : {"type" : type(e).__name__, "message" : str(e),
+				"traceback" : getattr(e, "traceback", "")}}
+
+		self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+class Render_Server:
+	""" Renders templates with engines that stay loaded between requests.
+
+	There's one engine per set of include paths and parser.  Template files
+	that changed since they were loaded are reloaded before each render.
+	Each request renders in its own ``Render_Context``, so changes a render
+	makes to module attributes don't carry over to the next request.
+
+	:param cache: directory for the module cache of the engines, or None
+	:param lazy: create the engines in lazy mode
+	"""
+
+	def __init__(self, cache = None, lazy = False):
+		self.cache = cache
+		self.lazy = lazy
+		self.engines = {}
+		self.renders = 0
+		self.server = None
+
+	def engine(self, includes, regex):
+		key = (tuple(includes), bool(regex))
+		engine = self.engines.get(key)
+		if engine is None:
+			engine = Engine()
+			engine.add_includes(includes)
+			engine.set_cache(self.cache)
+			engine.set_lazy(self.lazy)
+			self.engines[key] = engine
+
+		return engine
+
+	def render(self, request):
+		""" Renders a request, returning the output """
+		regex = request.get("regex", False)
+		engine = self.engine(request.get("includes", []), regex)
+		engine.refresh()
+
+		# a template that fails to load or make is left out of the engine,
+		# so the next request loads it again
+		parser = Regex_Parser() if regex else Parser()
+		state = engine._save_state()
+		try:
+			path = engine.load_file(request["template"], parser).path
+			engine._make([path])
+		except Exception:
+			engine._restore_state(state)
+			raise
+
+		output = engine.render(path, request.get("params", {}))
+		self.renders += 1
+		return output
+
+	def respond(self, request):
+		""" Renders a request and writes the output to the requested path,
+		returning the response dictionary.
+		"""
+		output = self.render(request)
+		out_path = request.get("output")
+		if not out_path:
+			return {"output" : output}
+
+		if request.get("if_changed"):
+			return {"output" : None, "changed" : files.write_if_changed(out_path, output)}
+
+		with open(out_path, "w") as f:
+			f.write(output)
+		return {"output" : None}
+
+	def serve(self, socket_path = default_socket):
+		""" Serves requests on ``socket_path`` until interrupted or until
+		``shutdown`` is called from another thread.
+		"""
+		if os.path.exists(socket_path):
+			os.remove(socket_path)
+
+		self.server = socketserver.UnixStreamServer(socket_path, Render_Handler)
+		self.server.respond = self.respond
+		try:
+			self.server.serve_forever()
+		finally:
+			self.server.server_close()
+			os.remove(socket_path)
+
+	def shutdown(self):
+		self.server.shutdown()
+
+def request(socket_path, template, params = {}, output = None, includes = [], regex = False,
+	if_changed = False):
+	""" Sends a render request to the server at ``socket_path``.
+
+	Relative paths are made absolute first, since the server runs in its own
+	directory.
+
+	:rtype: the response dictionary
+	"""
+	message = {
+		"template" : os.path.abspath(template),
+		"params" : params,
+		"output" : os.path.abspath(output) if output else None,
+		"includes" : [os.path.abspath(include) for include in includes],
+		"regex" : regex,
+		"if_changed" : if_changed,
+	}
+	data = json.dumps(message).encode("utf-8") + b"\n"
+
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+		client.connect(socket_path)
+		client.sendall(data)
+		with client.makefile("rb") as f:
+			return json.loads(f.readline().decode("utf-8"))
@@ -2,13 +2,36 @@
 # Licensed under the Apache License, Version 2.0
 
 import unittest
+import array
+import io
 import os.path
-from texthon.parser import Parser
-from texthon.engine import Engine
+import shutil
+import tempfile
+import asyncio
+from texthon.parser import Parser, Regex_Parser, Parse_Exception
+from texthon.engine import Engine, Exec_Exception, Output
+from texthon import utils
+from texthon import server
+from texthon.profiler import Profiler
+from texthon import export
+from texthon import files
+import importlib.util
+import socket
+import subprocess
+import sys
+import threading
+import time
 
 class Test_Templates(unittest.TestCase):
+	parser = Parser()
+	lazy = False
+
+	def module(self, engine, path):
+		return engine.modules[path]
+
 	def do_test(self, test_directory, template_file, param_file = "", out_file = None, includes = []):
 		engine = Engine()
+		engine.set_lazy(self.lazy)
 		directory = os.path.join("tests/", test_directory)
 
 		(template_path, param_path, out_path) = map(
@@ -18,7 +41,7 @@ class Test_Templates(unittest.TestCase):
 		includes = list(map(lambda x : os.path.join(directory, x), includes))
 
 		engine.add_includes(includes)
-		path = engine.load_file(template_path).path
+		path = engine.load_file(template_path, self.parser).path
 		engine.make()
 		params = {}
 
@@ -27,7 +50,7 @@ class Test_Templates(unittest.TestCase):
 			params = eval(f.read())
 			f.close()
 
-		output = engine.modules[path].main(**params)
+		output = self.module(engine, path).main(**params)
 
 		if out_file and os.path.exists(out_path):
 			f = open(out_path)
@@ -56,8 +79,981 @@ class Test_Templates(unittest.TestCase):
 
 	def test_nest(self):
 		self.do_test("nest", "main.tmpl", "nest.param", "nest.cpp")
+		# the same output, indented as it's written
+		self.do_test("nest", "indented.tmpl", "nest.param", "nest.cpp")
 
 	def test_cpp(self):
 		self.do_test("cpp", "types.tmpl", "types.param", "types.h")
 		self.do_test("cpp", "rtt.tmpl", "types.param", "rtt.h")
 
+
+class Test_Regex_Templates(Test_Templates):
+	parser = Regex_Parser()
+
+	def test_definitions(self):
+		corpora = [
+			("tests/basic/basic.tmpl.txt", []),
+			("tests/html/doc.tmpl", ["tests/html/sections"]),
+			("tests/nest/main.tmpl", []),
+			("tests/cpp/types.tmpl", []),
+			("tests/cpp/rtt.tmpl", []),
+		]
+
+		def definitions(path, includes, parser):
+			engine = Engine()
+			engine.add_includes(includes)
+			engine.load_file(path, parser)
+			return dict((key, [(name, t.code, t.text, t.source_lines, t.params)
+				for name, t in module.templates.items()])
+				for key, module in engine.modules.items())
+
+		for path, includes in corpora:
+			self.assertEqual(definitions(path, includes, Parser()),
+				definitions(path, includes, Regex_Parser()))
+
+	def test_text_lines(self):
+		lines = ["a$$b$>c", "x $< y $<z", "$$<a", "$$$<a", "${a}${b\\}}$c $ d$",
+			"${}x", "$1a", "\\#\\$a", "${a\\}", "$%a %b%%"]
+
+		def code(parser, line):
+			text = "#template main\n{}\n#end template\n".format(line)
+			return parser.process_module(io.StringIO(text), "test").templates["main"].code
+
+		for line in lines:
+			for placeholder in ("$", "$%"):
+				try:
+					expected = code(Parser("#", placeholder), line)
+				except Parse_Exception:
+					self.assertRaises(Parse_Exception, code, Regex_Parser("#", placeholder), line)
+					continue
+				self.assertEqual(expected, code(Regex_Parser("#", placeholder), line))
+
+class Test_Unfused_Templates(Test_Templates):
+	parser = Parser()
+	parser.optimize = False
+
+class Test_Exported_Templates(Test_Templates):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def module(self, engine, path):
+		module_path = os.path.join(self.directory, "exported.py")
+		with open(module_path, "w") as f:
+			export.export(engine, path, f)
+
+		spec = importlib.util.spec_from_file_location("exported", module_path)
+		module = importlib.util.module_from_spec(spec)
+		spec.loader.exec_module(module)
+		return module
+
+	def test_errors(self):
+		engine = Engine()
+		path = engine.load_file("tests/hello/hello.tmpl.txt").path
+		module = self.module(engine, path)
+		self.assertRaises(module.Exec_Exception, module.main, "a")
+		engine.make()
+		self.assertEqual(module.main("a", 1), engine.modules[path].main("a", 1))
+
+class Test_Lazy_Templates(Test_Templates):
+	lazy = True
+
+	def test_deferred(self):
+		directory = tempfile.mkdtemp()
+		try:
+			lib_path = os.path.join(directory, "lib.tmpl")
+			with open(lib_path, "w") as f:
+				f.write("#attribute v = 1\n#template used\nused $v$>\n#end template\n"
+					"#template unused\n${undefined}$>\n#end template\n")
+
+			engine = Engine()
+			engine.set_lazy(True)
+			engine.load_text("#load 'lib.tmpl' as lib\n#template main(use)\n"
+				"#{if use:\n${lib.used()}$>\n#}\n#end template\n", "main", directory)
+			engine.make()
+			main = engine.modules["main"]
+
+			self.assertEqual(main.main(False), "")
+			self.assertNotIn(lib_path, engine.definitions)
+			self.assertEqual(main.main(True), "used 1")
+
+			templates = engine.definitions[lib_path].templates
+			self.assertIsNotNone(templates["used"].compiled)
+			self.assertIsNone(templates["unused"].compiled)
+		finally:
+			shutil.rmtree(directory)
+
+class Test_Cache(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def render(self, template_path, **params):
+		engine = Engine()
+		engine.set_cache(os.path.join(self.directory, "cache"))
+		path = engine.load_file(template_path).path
+		engine.make()
+		return engine, engine.modules[path].main(**params)
+
+	def test_reuse(self):
+		engine, expected = self.render("tests/basic/basic.tmpl.txt", author = "someone", count = 5)
+		self.assertEqual(engine.cache.misses, 2)
+
+		engine, output = self.render("tests/basic/basic.tmpl.txt", author = "someone", count = 5)
+		self.assertEqual((engine.cache.hits, engine.cache.misses), (2, 0))
+		self.assertEqual(expected, output)
+
+	def test_invalidate(self):
+		path = os.path.join(self.directory, "main.tmpl")
+		with open(path, "w") as f:
+			f.write("#template main\nversion 1$>\n#end template\n")
+		engine, output = self.render(path)
+		self.assertEqual(output, "version 1")
+
+		# same size, different content
+		with open(path, "w") as f:
+			f.write("#template main\nversion 2$>\n#end template\n")
+		os.utime(path, (0, 0))
+		engine, output = self.render(path)
+		self.assertEqual(engine.cache.misses, 1)
+		self.assertEqual(output, "version 2")
+
+class Test_Includes(unittest.TestCase):
+	def test_listings(self):
+		directory = tempfile.mkdtemp()
+		try:
+			first, second = os.path.join(directory, "first"), os.path.join(directory, "second")
+			os.mkdir(first)
+			os.mkdir(second)
+			with open(os.path.join(second, "lib.tmpl"), "w") as f:
+				f.write("#attribute v = 2\n")
+
+			def load():
+				engine.load_text("#load 'lib.tmpl' as lib\n", "main")
+				return engine.definitions["main"].template_loads[0].path
+
+			engine = Engine()
+			engine.add_includes([first, second])
+			self.assertEqual(load(), os.path.join(second, "lib.tmpl"))
+			self.assertEqual(engine.resolve_stats["loads"], 1)
+			self.assertEqual(engine.resolve_stats["listings"], 2)
+
+			# new files are only seen once the listing is invalidated
+			with open(os.path.join(first, "lib.tmpl"), "w") as f:
+				f.write("#attribute v = 1\n")
+			del engine.definitions["main"]
+			self.assertEqual(load(), os.path.join(second, "lib.tmpl"))
+			self.assertEqual(engine.resolve_stats["listings"], 2)
+
+			engine.invalidate_listings(first)
+			del engine.definitions["main"]
+			self.assertEqual(load(), os.path.join(first, "lib.tmpl"))
+			self.assertEqual(engine.resolve_stats["listings"], 3)
+		finally:
+			shutil.rmtree(directory)
+
+class Test_Parallel(unittest.TestCase):
+	def load(self, template, includes, *parallel):
+		engine = Engine()
+		engine.add_includes(includes)
+		if parallel:
+			engine.set_parallel(*parallel)
+		engine.load_file(template)
+		return engine
+
+	def summary(self, engine):
+		return [(path, list(module.templates),
+			[func.code for func in module.templates.values()],
+			[load.path for load in module.template_loads])
+			for path, module in engine.definitions.items()]
+
+	def test_same_as_serial(self):
+		for template, includes in (
+			("tests/html/doc.tmpl", ["tests/html/sections"]),
+			("tests/cpp/rtt.tmpl", [])):
+			expected = self.summary(self.load(template, includes))
+			self.assertEqual(self.summary(self.load(template, includes, 4)), expected)
+			self.assertEqual(self.summary(self.load(template, includes, 2, 2, 0)), expected)
+
+	def test_resolve_stats(self):
+		serial = self.load("tests/html/doc.tmpl", ["tests/html/sections"])
+		parallel = self.load("tests/html/doc.tmpl", ["tests/html/sections"], 4)
+		self.assertGreater(serial.resolve_stats["loads"], 0)
+		self.assertEqual(parallel.resolve_stats["loads"], serial.resolve_stats["loads"])
+
+	def test_errors(self):
+		engine = Engine()
+		engine.set_parallel(4)
+		self.assertRaises(OSError, engine.load_text,
+			"#load 'tests/basic/basic.tmpl.txt' as a\n#load 'missing.tmpl' as b\n", "main")
+		self.assertIn(os.path.abspath("tests/basic/basic.tmpl.txt"), engine.definitions)
+
+class Test_Batch(unittest.TestCase):
+	def test_render_many(self):
+		engine = Engine()
+		template = "tests/hello/hello.tmpl.txt"
+		param_sets = [{"who" : "a", "count" : 1}, {"who" : "b"}, {"who" : "c", "count" : 2}]
+		results = engine.render_many(template, param_sets)
+		self.assertEqual(results, engine.render_many(template, param_sets, 2))
+
+		self.assertEqual(results[0], (engine.modules[os.path.abspath(template)].main("a", 1), None))
+		self.assertIsNone(results[1][0])
+		self.assertIn("count", results[1][1])
+		self.assertIsNone(results[2][1])
+
+		output, error = engine.render_jobs([("tests/hello/missing.tmpl", {})])[0]
+		self.assertIsNone(output)
+		self.assertIn("missing.tmpl", error)
+
+	def test_isolated_jobs(self):
+		engine = Engine()
+		engine.load_text("#attribute count = 0\n#template main\n#! _module.count += 1\n"
+			"render $count$>\n#end template\n", "counter")
+		jobs = [("counter", {})] * 4
+		self.assertEqual(engine.render_jobs(jobs), [("render 1", None)] * 4)
+		self.assertEqual(engine.render_jobs(jobs, 2), [("render 1", None)] * 4)
+		self.assertEqual(engine.modules["counter"].count, 0)
+
+	def test_failed_make(self):
+		engine = Engine()
+		engine.load_text("#template main\ngood$>\n#end template\n", "good")
+		engine.load_text("#template main\n#! x = (\n#end template\n", "syntax")
+		engine.load_text("#attribute a = undefined\n#template main\n#end template\n", "attribute")
+		results = engine.render_jobs([("syntax", {}), ("good", {}), ("attribute", {})], 2)
+
+		self.assertEqual(results[1], ("good", None))
+		self.assertIn("never closed", results[0][1])
+		self.assertIn("undefined", results[2][1])
+		self.assertEqual(list(engine.modules), ["good"])
+
+	def test_failed_load(self):
+		directory = tempfile.mkdtemp()
+		try:
+			main_path = os.path.join(directory, "main.tmpl")
+			with open(main_path, "w") as f:
+				f.write("#load 'missing.tmpl' as missing\n#template main\n${missing.f()}\n#end template\n")
+
+			engine = Engine()
+			for attempt in range(2):
+				output, error = engine.render_jobs([(main_path, {})])[0]
+				self.assertIn("missing.tmpl", error)
+				self.assertEqual((engine.definitions, engine.dependents, engine.modules), ({}, {}, {}))
+		finally:
+			shutil.rmtree(directory)
+
+@unittest.skipUnless(hasattr(socket, "AF_UNIX"), "needs unix domain sockets")
+class Test_Server(unittest.TestCase):
+	def test_requests(self):
+		directory = tempfile.mkdtemp()
+		socket_path = os.path.join(directory, "texthon.sock")
+		render_server = server.Render_Server()
+		thread = threading.Thread(target = render_server.serve, args = (socket_path,))
+		thread.start()
+		try:
+			while render_server.server is None or not os.path.exists(socket_path):
+				time.sleep(0.01)
+
+			template = "tests/html/doc.tmpl"
+			response = server.request(socket_path, template, includes = ["tests/html/sections"])
+			with open("tests/html/doc.html") as f:
+				self.assertEqual(response, {"output" : f.read()})
+
+			out_path = os.path.join(directory, "out.txt")
+			response = server.request(socket_path, "tests/hello/hello.tmpl.txt",
+				{"who" : "a", "count" : 1}, out_path)
+			self.assertEqual(response, {"output" : None})
+			self.assertTrue(os.path.exists(out_path))
+
+			response = server.request(socket_path, "tests/hello/hello.tmpl.txt",
+				{"who" : "a", "count" : 1}, out_path, if_changed = True)
+			self.assertEqual(response, {"output" : None, "changed" : False})
+
+			response = server.request(socket_path, "tests/hello/hello.tmpl.txt", {"who" : "a"})
+			self.assertEqual(response["error"]["type"], "Exec_Exception")
+			self.assertEqual(render_server.renders, 3)
+
+			# module attributes set by a render don't carry over
+			counter_path = os.path.join(directory, "counter.tmpl")
+			with open(counter_path, "w") as f:
+				f.write("#attribute count = 0\n#template main\n#! _module.count += 1\n"
+					"render $count$>\n#end template\n")
+			for index in range(3):
+				self.assertEqual(server.request(socket_path, counter_path), {"output" : "render 1"})
+
+			failing_path = os.path.join(directory, "failing.tmpl")
+			with open(failing_path, "w") as f:
+				f.write("#template main\n${1 // 0}\n#end template\n")
+			error = server.request(socket_path, failing_path)["error"]
+			self.assertIn("execution aborted", error["message"])
+			self.assertIn("${1 // 0}", error["traceback"])
+			self.assertIn("ZeroDivisionError", error["traceback"])
+
+			# a failed load doesn't stay in the engine
+			main_path = os.path.join(directory, "main.tmpl")
+			lib_path = os.path.join(directory, "lib.tmpl")
+			with open(main_path, "w") as f:
+				f.write("#load 'lib.tmpl' as lib\n#template main\n${lib.f()}$>\n#end template\n")
+			with open(lib_path, "w") as f:
+				f.write("#template f\n#}\n#end template\n")
+			for index in range(2):
+				error = server.request(socket_path, main_path)["error"]
+				self.assertEqual(error["type"], "Parse_Exception")
+			with open(lib_path, "w") as f:
+				f.write("#template f\nfixed$>\n#end template\n")
+			self.assertEqual(server.request(socket_path, main_path), {"output" : "fixed"})
+		finally:
+			render_server.shutdown()
+			thread.join()
+			shutil.rmtree(directory)
+
+class Test_Files(unittest.TestCase):
+	def test_write_if_changed(self):
+		directory = tempfile.mkdtemp()
+		try:
+			path = os.path.join(directory, "types.h")
+			self.assertTrue(files.write_if_changed(path, "int a;\n"))
+			os.chmod(path, 0o640)
+			os.utime(path, (1, 1))
+
+			self.assertFalse(files.write_if_changed(path, "int a;\n"))
+			self.assertEqual(os.stat(path).st_mtime, 1)
+
+			# same size, different content
+			self.assertTrue(files.write_if_changed(path, "int b;\n"))
+			with open(path) as f:
+				self.assertEqual(f.read(), "int b;\n")
+			self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+			self.assertEqual(os.listdir(directory), ["types.h"])
+		finally:
+			shutil.rmtree(directory)
+
+	def test_output_writer(self):
+		directory = tempfile.mkdtemp()
+		try:
+			with files.Output_Writer() as writer:
+				writer.write(os.path.join(directory, "a.h"), "a")
+				writer.write(os.path.join(directory, "include", "b.h"), "b")
+			self.assertEqual((writer.written, writer.changed), (2, 2))
+
+			writer = files.Output_Writer()
+			writer.write(os.path.join(directory, "a.h"), "a")
+			writer.write(os.path.join(directory, "include", "b.h"), "c")
+			writer.close()
+			self.assertEqual((writer.written, writer.changed), (2, 1))
+			with open(os.path.join(directory, "include", "b.h")) as f:
+				self.assertEqual(f.read(), "c")
+		finally:
+			shutil.rmtree(directory)
+
+	def test_dependencies(self):
+		engine = Engine()
+		path = engine.load_file("tests/cpp/types.tmpl").path
+		directory = os.path.dirname(path)
+		self.assertEqual(engine.dependencies(path), [os.path.join(directory, name)
+			for name in ("processor.py", "types.tmpl", "types.tmpl.h")])
+
+		out = io.StringIO()
+		files.write_depfile(out, ["my types.h"], ["a.tmpl", "b$.py"])
+		self.assertEqual(out.getvalue(), "my\\ types.h: \\\n  a.tmpl \\\n  b$$.py\n")
+
+	def test_input_manifest(self):
+		directory = tempfile.mkdtemp()
+		try:
+			input_path = os.path.join(directory, "types.param")
+			with open(input_path, "w") as f:
+				f.write("{}")
+			manifest_path = os.path.join(directory, "manifest.json")
+
+			manifest = files.Input_Manifest(manifest_path, {"params" : ["a=1"]})
+			self.assertFalse(manifest.up_to_date())
+			manifest.record([input_path])
+			self.assertTrue(manifest.up_to_date())
+			self.assertFalse(manifest.up_to_date([os.path.join(directory, "missing.h")]))
+			self.assertFalse(files.Input_Manifest(manifest_path, {"params" : []}).up_to_date())
+
+			# touched without changing the content
+			os.utime(input_path, (1, 1))
+			self.assertTrue(manifest.up_to_date())
+
+			with open(input_path, "w") as f:
+				f.write("{1}")
+			self.assertFalse(manifest.up_to_date())
+		finally:
+			shutil.rmtree(directory)
+
+class Test_Script(unittest.TestCase):
+	def run_script(self, *args):
+		env = dict(os.environ, PYTHONPATH = os.path.abspath("."))
+		subprocess.run([sys.executable, "scripts/texthon", "--no-server"] + list(args),
+			env = env, check = True)
+
+	def test_input_manifest_params(self):
+		directory = tempfile.mkdtemp()
+		try:
+			out_path = os.path.join(directory, "out.txt")
+			manifest_path = os.path.join(directory, "manifest.json")
+			other_path = os.path.join(directory, "other.param")
+			with open(other_path, "w") as f:
+				f.write("{'who' : 'other', 'count' : 1}")
+
+			# the manifest only tracks the param file it recorded, switching files renders again
+			for param_path, who in (("tests/hello/hello.param", "someone"), (other_path, "other")):
+				self.run_script("tests/hello/hello.tmpl.txt", "-pf", param_path,
+					"-o", out_path, "-im", manifest_path)
+				with open(out_path) as f:
+					self.assertTrue(f.read().startswith(who + " says:"))
+		finally:
+			shutil.rmtree(directory)
+
+class Test_Threads(unittest.TestCase):
+	lib = """#attribute value = 0
+#template show
+$value$>
+#end template
+"""
+	main = """#import time as time
+#load "lib.tmpl" as lib
+#template main(n)
+#! lib.value = n
+#! _module.seen = n
+#! mixin = lib()
+#! mixin.value = -n
+#{for i in range(20):
+#! time.sleep(0)
+${lib.show()} $seen ${mixin.show()}
+#}
+#end template
+"""
+
+	def test_concurrent_renders(self):
+		directory = tempfile.mkdtemp()
+		try:
+			for name, text in (("lib.tmpl", self.lib), ("main.tmpl", self.main)):
+				with open(os.path.join(directory, name), "w") as f:
+					f.write(text)
+
+			engine = Engine()
+			path = engine.load_file(os.path.join(directory, "main.tmpl")).path
+			engine.make()
+
+			failures = []
+			def render(thread):
+				for index in range(50):
+					n = thread * 1000 + index
+					output = engine.render(path, {"n" : n})
+					if output != "{} {} {}\n".format(n, n, -n) * 20:
+						failures.append(output)
+
+			threads = [threading.Thread(target = render, args = (thread,)) for thread in range(8)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+
+			self.assertEqual(failures, [])
+			self.assertEqual(engine.modules[path].lib.value, 0)
+			self.assertNotIn("seen", engine.modules[path].__dict__)
+		finally:
+			shutil.rmtree(directory)
+
+	def test_mixin_attributes(self):
+		directory = tempfile.mkdtemp()
+		try:
+			for name, text in (
+				("base.tmpl", "#attribute count = 0\n#template bump\n#! _module.count += 1\n$count$>\n#end template\n"),
+				("other.tmpl", "#attribute x = 1\n"),
+				("main.tmpl", "#load 'base.tmpl' as base\n#load 'other.tmpl' as other\n"
+					"#attribute mixed = other(base)\n#template main\n${mixed.bump()}$>\n#end template\n")):
+				with open(os.path.join(directory, name), "w") as f:
+					f.write(text)
+
+			engine = Engine()
+			path = engine.load_file(os.path.join(directory, "main.tmpl")).path
+			engine.make()
+			self.assertEqual([engine.render(path) for index in range(3)], ["1"] * 3)
+			self.assertEqual(engine.modules[os.path.join(directory, "base.tmpl")].count, 0)
+		finally:
+			shutil.rmtree(directory)
+
+	def test_lazy_renders(self):
+		lib = "".join("#template f{0}\nf{0}$>\n#end template\n".format(index) for index in range(200))
+		main = "#load 'lib.tmpl' as lib\n#template main(n)\n${lib.f199()} $n$>\n#end template\n"
+		directory = tempfile.mkdtemp()
+		interval = sys.getswitchinterval()
+		try:
+			with open(os.path.join(directory, "lib.tmpl"), "w") as f:
+				f.write(lib)
+
+			# switch threads often, so renders copy the module while the
+			# first of them is making it
+			sys.setswitchinterval(1e-6)
+			for trial in range(50):
+				engine = Engine()
+				engine.set_lazy(True)
+				engine.load_text(main, "main", directory)
+				engine.make()
+
+				results = {}
+				barrier = threading.Barrier(8)
+				def render(thread):
+					barrier.wait()
+					try:
+						results[thread] = engine.render("main", {"n" : thread})
+					except Exception as e:
+						results[thread] = e
+
+				threads = [threading.Thread(target = render, args = (thread,)) for thread in range(8)]
+				for thread in threads:
+					thread.start()
+				for thread in threads:
+					thread.join()
+
+				self.assertEqual(results, {thread : "f199 {}".format(thread) for thread in range(8)})
+		finally:
+			sys.setswitchinterval(interval)
+			shutil.rmtree(directory)
+
+	def test_deferred_copies(self):
+		directory = tempfile.mkdtemp()
+		try:
+			lib_path = os.path.join(directory, "lib.tmpl")
+			with open(lib_path, "w") as f:
+				f.write(self.lib)
+
+			engine = Engine()
+			engine.set_lazy(True)
+			engine.load_text("#load 'lib.tmpl' as lib\n#template main(use)\n"
+				"#{if use:\n${lib.show()}$>\n#}\n#end template\n", "main", directory)
+			engine.make()
+
+			# copying the deferred module doesn't load it
+			self.assertEqual(engine.render("main", {"use" : False}), "")
+			self.assertNotIn(lib_path, engine.definitions)
+			self.assertEqual(engine.render("main", {"use" : True}), "0")
+			self.assertIn(lib_path, engine.definitions)
+			self.assertEqual(engine.render("main", {"use" : True}), "0")
+		finally:
+			shutil.rmtree(directory)
+
+	def test_shared_memo(self):
+		engine = Engine()
+		engine.load_text("""#attribute calls = []
+#template main(n)
+${name(n)}$>
+#end template
+#template name(n) (cache)
+#! calls.append(n)
+n$n$>
+#end template
+""", "main")
+		engine.make()
+
+		for index in range(3):
+			self.assertEqual(engine.render("main", {"n" : 1}), "n1")
+		self.assertEqual(engine.modules["main"].calls, [1])
+		self.assertEqual(engine.memo_stats["hits"], 2)
+		self.assertEqual(engine.modules["main"].main(1), "n1")
+		self.assertEqual(engine.modules["main"].calls, [1])
+
+class Test_Refresh(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def write(self, name, text, mtime):
+		path = os.path.join(self.directory, name)
+		with open(path, "w") as f:
+			f.write(text)
+		os.utime(path, (mtime, mtime))
+		return path
+
+	def test_refresh(self):
+		main_path = self.write("main.tmpl", "#load 'lib.tmpl' as lib\n#attribute v = lib.v\n"
+			"#template main\n${lib.f()} $v$>\n#end template\n", 1)
+		lib_path = self.write("lib.tmpl", "#attribute v = 1\n#template f\nold$>\n#end template\n", 1)
+		other_path = self.write("other.tmpl", "#template main\nother$>\n#end template\n", 1)
+
+		engine = Engine()
+		engine.load_file(main_path)
+		engine.load_file(other_path)
+		engine.make()
+		main = engine.modules[main_path]
+		self.assertEqual(main.main(), "old 1")
+		self.assertEqual(engine.refresh(), [])
+
+		self.write("lib.tmpl", "#attribute v = 2\n#template f\nnew$>\n#end template\n", 2)
+		self.assertEqual(engine.refresh(), sorted([main_path, lib_path]))
+		self.assertIs(engine.modules[main_path], main)
+		self.assertEqual(main.main(), "new 2")
+
+		# a broken edit leaves the module as it was
+		self.write("lib.tmpl", "#template f\n#}\n#end template\n", 3)
+		self.assertRaises(Parse_Exception, engine.refresh)
+		self.assertEqual(main.main(), "new 2")
+
+	def test_refresh_memo(self):
+		main_path = self.write("main.tmpl", "#template main\n${name()}$>\n#end template\n"
+			"#template name() (cache)\nold$>\n#end template\n", 1)
+		other_path = self.write("other.tmpl", "#template main() (cache)\nother$>\n#end template\n", 1)
+
+		engine = Engine()
+		engine.load_file(main_path)
+		engine.load_file(other_path)
+		engine.make()
+		self.assertEqual((engine.modules[main_path].main(), engine.modules[other_path].main()),
+			("old", "other"))
+
+		# the remade module starts with an empty cache, the others keep theirs
+		self.write("main.tmpl", "#template main\n${name()}$>\n#end template\n"
+			"#template name() (cache)\nnew$>\n#end template\n", 2)
+		engine.refresh()
+		self.assertEqual((engine.modules[main_path].main(), engine.modules[other_path].main()),
+			("new", "other"))
+		self.assertEqual(engine.memo_stats["hits"], 1)
+
+	def test_refresh_all_or_nothing(self):
+		main_path = self.write("main.tmpl", "#load 'lib.tmpl' as lib\n#load 'util.tmpl' as util\n"
+			"#template main\n${lib.f()} ${util.g()}$>\n#end template\n", 1)
+		lib_path = self.write("lib.tmpl", "#template f\nold$>\n#end template\n", 1)
+		util_path = self.write("util.tmpl", "#template g\nold$>\n#end template\n", 1)
+
+		engine = Engine()
+		engine.load_file(main_path)
+		engine.make()
+		main = engine.modules[main_path]
+
+		# the valid edit of lib isn't applied while util doesn't compile
+		self.write("lib.tmpl", "#template f\nnew$>\n#end template\n", 2)
+		self.write("util.tmpl", "#template g\n#! x = (\n#end template\n", 2)
+		self.assertRaises(SyntaxError, engine.refresh)
+		self.assertEqual(main.main(), "old old")
+		self.assertEqual(engine.pending, set())
+
+		self.write("util.tmpl", "#template g\nnew$>\n#end template\n", 3)
+		self.assertEqual(engine.refresh(), sorted([main_path, lib_path, util_path]))
+		self.assertEqual(main.main(), "new new")
+
+class Test_Functions(unittest.TestCase):
+	def make(self, text):
+		engine = Engine()
+		engine.load_text(text, "test.tmpl")
+		engine.make()
+		return engine.modules["test.tmpl"]
+
+	def test_params(self):
+		module = self.make("#template main(a, b)\n$a ${b}$>\n#end template\n")
+		self.assertEqual(module.main(1, b = 2), "1 2")
+		self.assertRaises(Exec_Exception, module.main, 1)
+		self.assertRaises(Exec_Exception, module.main, 1, 2, 3)
+
+	def test_globals(self):
+		module = self.make("#attribute name = 'a'\n#template main\n$name$>\n#end template\n")
+		self.assertEqual(module.main(), "a")
+		module.name = "b"
+		self.assertEqual(module.main(), "b")
+
+	def test_memoize(self):
+		module = self.make("""#attribute calls = []
+#template name(n) (cache = 2)
+#! calls.append(n)
+n$n$>
+#end template
+#template main(n)
+${name(n)} ${name(n)}$>
+#end template
+""")
+		stats = module.name.stats
+		self.assertEqual(module.main(1), "n1 n1")
+		self.assertEqual(module.main(1.0), "n1.0 n1.0")
+		self.assertEqual(module.calls, [1, 1.0])
+		self.assertEqual(stats, {"hits" : 2, "misses" : 2, "uncacheable" : 0})
+
+		# least recently used outputs are dropped
+		module.name(2)
+		module.name(1.0)
+		module.name(1)
+		self.assertEqual(module.calls, [1, 1.0, 2, 1])
+
+		self.assertEqual(module.name([3]), "n[3]")
+		self.assertEqual(module.name([3]), "n[3]")
+		self.assertEqual(stats["uncacheable"], 2)
+		self.assertRaises(Exec_Exception, module.name)
+
+		self.assertRaises(Parse_Exception, self.make, "#template name(n) (size = 2)\n#end template\n")
+
+	def test_memo_bindings(self):
+		module = self.make("""#attribute calls = []
+#attribute prefix = "n"
+#template name(n) (cache = 4)
+#! calls.append(n)
+$prefix$n$>
+#end template
+""")
+		mixin = module()
+		mixin.prefix = "m"
+		self.assertEqual((module.name(1), mixin.name(1)), ("n1", "m1"))
+		self.assertIs(mixin.name.memo, module.name.memo)
+
+		# rebinding keeps the outputs
+		del mixin.name
+		self.assertEqual((module.name(1), mixin.name(1)), ("n1", "m1"))
+		self.assertEqual(module.calls, [1, 1])
+
+	def test_profile(self):
+		profiler = Profiler(memory = False)
+		engine = Engine()
+		engine.set_profiler(profiler)
+		engine.load_text("""#template main(n)
+#{for i in range(n):
+${inner(i)}
+#}
+#end template
+#template inner(i)
+i$i$>
+#end template
+""", "test.tmpl")
+		engine.make()
+		self.assertEqual(engine.modules["test.tmpl"].main(2), "i0\ni1\n")
+
+		main, inner = profiler.entries[("test.tmpl", "main")], profiler.entries[("test.tmpl", "inner")]
+		self.assertEqual((main.calls, main.emitted, main.exclusive_emitted), (1, 6, 2))
+		self.assertEqual((inner.calls, inner.emitted), (2, 4))
+		self.assertLessEqual(main.exclusive, main.inclusive)
+
+		out = io.StringIO()
+		profiler.write_collapsed(out)
+		stacks = [line.rsplit(" ", 1)[0] for line in out.getvalue().splitlines()]
+		self.assertEqual(stacks, ["test.tmpl:main", "test.tmpl:main;test.tmpl:inner"])
+
+	def test_async(self):
+		module = self.make("""#import asyncio as asyncio
+#template main(n)
+#! _module.ready = asyncio.Event()
+${waiter(n)}|${setter()}|${await data(n)}$>
+#end template
+#template waiter(n)
+#! await ready.wait()
+waiter $n$>
+#end template
+#template setter
+#! await asyncio.sleep(0)
+#! ready.set()
+setter$>
+#end template
+#template data(n)
+${await asyncio.sleep(0, n * 2)}$>
+#end template
+#template plain
+${setter()}$>
+#end template
+""")
+		self.assertTrue(module.waiter.is_async)
+		self.assertFalse(module.plain.is_async)
+
+		# the waiter only finishes if the setter runs while it waits
+		render = module.main.render_async(1)
+		self.assertEqual(asyncio.run(asyncio.wait_for(render, 1)), "waiter 1|setter|2")
+		self.assertEqual(asyncio.run(module.data(2)), "4")
+		self.assertEqual(asyncio.run(module.plain.render_async()), "setter")
+		self.assertRaises(Exec_Exception, module.plain)
+
+	def test_async_indent(self):
+		module = self.make("""#import asyncio as asyncio
+#template main
+{
+#{with _output.indented():
+${sync_line()}
+${async_line("async")}
+${async_line("")}
+x ${async_line("a" + chr(10))}y
+#}
+}
+#end template
+#template sync_line
+sync$>
+#end template
+#template async_line(text)
+#! await asyncio.sleep(0)
+$text$>
+#end template
+""")
+		self.assertEqual(asyncio.run(module.main.render_async()),
+			"{\n\tsync\n\tasync\n\n\tx a\n\ty\n}\n")
+
+	def test_nested_calls(self):
+		text = """#template main(n)
+${inner(n, func = "f")}|${len(inner(n, func = "f"))}|${"".join(c for c in "ab")}$>
+#end template
+#template inner(n, func)
+$func$n$>
+#end template
+"""
+		definition = Engine().load_text(text, "test.tmpl").templates["main"]
+		self.assertIn("_output.call(inner, n, func", definition.code)
+		self.assertEqual(self.make(text).main(1), "f1|2|ab")
+
+	def test_indent(self):
+		text = """#template main(n)
+{
+#{with _output.indented():
+${block(n)}
+#}
+}
+#end template
+#template block(n)
+line $n
+  two spaces
+#{if n:
+#{with _output.indented(2):
+${block(n - 1)}$>
+#}
+#}
+#end template
+"""
+		module = self.make(text)
+		indent = utils.Indent()
+		def block(n):
+			inner = indent.indent(block(n - 1), 2) if n else ""
+			return "line {}\n  two spaces\n{}".format(n, inner)
+		expected = "{\n" + indent.indent(block(3) + "\n") + "}\n"
+		self.assertEqual(module.main(3), expected)
+
+		output = Output()
+		output.write("x = ")
+		output.push_indent(1, utils.Indent(2, False))
+		output.write("[\n\t1,")
+		output.write("\n")
+		output.push_indent()
+		output.write("2\n")
+		output.pop_indent()
+		output.pop_indent()
+		output.write("]\n")
+		self.assertEqual(output.getvalue(), "x =   [\n    1,\n    2\n]\n")
+		self.assertRaises(ValueError, output.pop_indent)
+
+	def test_outputs(self):
+		text = """#template main(types)
+#{for t in types:
+#! _outputs[t + ".h"].call(header, t)
+#}
+${len(types)} headers$>
+#end template
+#template header(t)
+struct $t {};
+#end template
+"""
+		module = self.make(text)
+		self.assertEqual(module.main.render_outputs(["a", "b"]),
+			("2 headers", {"a.h" : "struct a {};\n", "b.h" : "struct b {};\n"}))
+		self.assertEqual(module.main.render_outputs([]), ("0 headers", {}))
+		self.assertRaises(Exec_Exception, module.main, ["a"])
+
+		self.assertRaises(Parse_Exception, self.make, "#template header(t) (cache)\n"
+			"#! _outputs[t + '.h'].write(t)\n#end template\n")
+
+	def test_rebind(self):
+		module = self.make("#attribute x = 1\n#template f\n$x ${_module.x}$>\n#end template\n")
+		mixin = module()
+		mixin.x = 2
+		self.assertEqual((module.f(), mixin.f()), ("1 1", "2 2"))
+
+		func, copy = module.f, mixin.f
+		self.assertFalse(hasattr(copy, "__dict__"))
+		self.assertIsInstance(copy.source_lines, array.array)
+		self.assertIs(copy.text, func.text)
+		self.assertIs(copy.source_lines, func.source_lines)
+		self.assertIs(copy.function.__kwdefaults__, func.function.__kwdefaults__)
+
+	def test_parallel_map(self):
+		module = self.make("""#template main(count)
+${"".join(_utils.parallel_map(row, range(count), processes = 3))}$>
+#end template
+#template row(n)
+${n * 2},$>
+#end template
+""")
+		self.assertEqual(module.main(20), "".join("{},".format(n * 2) for n in range(20)))
+		self.assertEqual(utils.parallel_map(module.row, [1, 2], processes = 2), ["2,", "4,"])
+		self.assertRaises(utils.Map_Exception, utils.parallel_map, module.row, [1, None],
+			processes = 2)
+
+		# render_jobs workers can't start workers of their own
+		engine = Engine()
+		engine.load_text("#template main(count)\n"
+			"${\"\".join(_utils.parallel_map(str, range(count), processes = 2))}$>\n"
+			"#end template\n", "test.tmpl")
+		self.assertEqual(engine.render_jobs([("test.tmpl", {"count" : 3})] * 2, 2),
+			[("012", None)] * 2)
+
+	def test_fused_writes(self):
+		text = """#template main(a, b)
+100% ${a, b} $a%s
+#{if a:
+$b$$
+#}
+#end template
+"""
+		definition = Engine().load_text(text, "test.tmpl").templates["main"]
+		self.assertEqual(definition.code.count("_write("), 2)
+		self.assertEqual(self.make(text).main(1, "x"), "100% (1, 'x') 1%s\nx$\n")
+
+class Test_Modules(unittest.TestCase):
+	def setUp(self):
+		engine = Engine()
+		for name in ("a", "b", "c"):
+			engine.load_text("#attribute name = '{0}'\n#attribute {0} = 1\n".format(name), name)
+		engine.make()
+		self.modules = engine.modules
+
+	def test_lookup(self):
+		a, b, c = (self.modules[name] for name in ("a", "b", "c"))
+		mixin = a(b, c)
+		self.assertEqual(mixin.name, "a")
+		self.assertEqual((mixin.b, mixin.c), (1, 1))
+		self.assertEqual(a._base, [])
+		self.assertRaises(AttributeError, getattr, mixin, "d")
+
+		# cached lookups see assignments to the bases
+		b.b = 2
+		self.assertEqual(mixin.b, 2)
+		c.b = 3
+		self.assertEqual(mixin(c).b, 2)
+		self.assertEqual(b(c).b, 2)
+
+		# base order follows C3 linearization
+		self.assertEqual(mixin(b, c)._mro, [b, c])
+		self.assertEqual(a(b(c), c)._mro[1:], [c])
+
+	def test_loop(self):
+		a, b = self.modules["a"], self.modules["b"]
+		b._base.append(b)
+		self.assertRaises(TypeError, a, b)
+
+	def test_lazy_binding(self):
+		engine = Engine()
+		engine.load_text("""#attribute row = 1
+#template main
+${inner()}$>
+#end template
+#template inner
+row $row$>
+#end template
+#template unused
+#end template
+""", "lib")
+		engine.make()
+		lib = engine.modules["lib"]
+
+		mixin = lib(self.modules["a"])
+		mixin.row = 5
+		self.assertEqual(mixin.main(), "row 5")
+		self.assertEqual(mixin._bound, set(["main", "inner"]))
+		self.assertIs(mixin.main.module, mixin)
+		self.assertEqual(lib.main(), "row 1")
+		self.assertIs(lib(self.modules["a"])._mro, mixin._mro)
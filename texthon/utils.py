@@ -2,6 +2,9 @@
 # Licensed under the Apache License, Version 2.0
 
 from . import base
+import multiprocessing
+import os
+import sys
 
 class Indent:
 	""" Utility class for controlling text indentation.
@@ -78,3 +81,59 @@ class Indent:
 		
 		return out_stream.getvalue()
 
+class Map_Exception(Exception):
+	""" Raised by ``parallel_map`` when a call failed in a worker process """
+
+# the function the worker processes of parallel_map call
+_map_function = None
+
+def _map_init(func):
+	global _map_function
+	_map_function = func
+
+def _map_call(args):
+	try:
+		return _map_function(*args), None
+	except Exception as e:
+		return None, "{}: {}".format(type(e).__name__, e)
+
+def parallel_map(func, *iterables, processes = None, chunksize = None):
+	""" Returns ``list(map(func, *iterables))``, with the calls spread over
+	worker processes forked from the current one, so the workers start with
+	the made template modules.  Meant for template functions rendering the
+	independent items of a long sequence::
+
+		${"".join(_utils.parallel_map(header, types))}
+
+	The arguments and results have to be picklable, and changes the calls
+	make to modules stay in the workers.  The calls run in this process if
+	there are fewer than two items or processes, if the platform can't fork,
+	or when called from a worker process, such as a worker of another
+	``parallel_map`` or of ``Engine.render_jobs``.
+
+	:param processes: the number of worker processes, the number of CPUs by
+		default
+	:param chunksize: the number of items sent to a worker at a time
+	"""
+	items = list(zip(*iterables))
+	if processes is None:
+		processes = os.cpu_count() or 1
+	processes = min(processes, len(items))
+
+	# the workers find _map_call through its module
+	importable = getattr(sys.modules.get(__name__), "_map_call", None) is _map_call
+	# daemonic processes, such as the workers of Engine.render_jobs, can't
+	# start workers of their own
+	if (processes < 2 or _map_function is not None or not importable or
+		multiprocessing.current_process().daemon or
+		"fork" not in multiprocessing.get_all_start_methods()):
+		return [func(*item) for item in items]
+
+	with multiprocessing.get_context("fork").Pool(processes, _map_init, (func,)) as pool:
+		results = pool.map(_map_call, items, chunksize)
+
+	for index, (result, error) in enumerate(results):
+		if error is not None:
+			raise Map_Exception("item {}: {}".format(index, error))
+
+	return [result for result, error in results]